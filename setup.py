@@ -16,7 +16,7 @@ setup(
     packages=["tagg"],
     entry_points={
         'console_scripts': [
-            "tagg = tagg.cli:main",
+            "tagg = tagg.client:main",
             "autotagg = tagg.autotag:main",
         ]
     },
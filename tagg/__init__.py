@@ -1,13 +1,18 @@
 from collections import Counter
+from contextlib import contextmanager
+from itertools import izip
 import os
 import json
 import sys
 import datetime
 import re
 import shutil
+import time
 import os.path as path
 
-from .github import GithubHelper
+from .index import LinkIndex, TokenIndex, TombstoneLog, atomic_json_dump, \
+    scan_dirs
+from .query import QueryEvaluator, parse_query
 
 
 def timestamp():
@@ -22,6 +27,12 @@ def json_dumps(data):
     return json.dumps(data, indent=2, sort_keys=True)
 
 
+def GithubHelper(*args, **kwargs):
+    # Imported on first use, so cmds which don't talk to Github start faster
+    from .github import GithubHelper
+    return GithubHelper(*args, **kwargs)
+
+
 class Error(Exception):
     pass
 
@@ -32,13 +43,44 @@ class NotLoaded(dict):
 
 NOTLOADED = NotLoaded()
 
+# How much of a key MetaStore.load_meta reads: whether it exists, its links
+# with the meta json parsed on first access, or everything right away
+LOAD_KEY = 0
+LOAD_LINKS = 1
+LOAD_FULL = 2
+
+
+_interned = {}
+
+
+def intern_key(key):
+    # Like intern(), but for unicode too. Keys and meta fields are repeated
+    # across stores, links and the loaded json, so they're kept only once.
+    return _interned.setdefault(key, key)
+
+
+def load_json(f):
+    return json.load(f, object_pairs_hook=lambda pairs: dict(
+        (intern_key(k), v) for k, v in pairs))
+
 
 class Meta(object):
+    # Many of these are held at once, as the links of every repo, hence the
+    # slots. The meta dict is shared with the Meta it was copied from until
+    # it's accessed through .meta, which is when it may be changed. Read
+    # fields with get() to keep sharing it. If _lazy is set, it's the json
+    # file the meta dict is parsed from on first access, or the Meta not
+    # parsed yet it was copied from, which is parsed once for all its copies.
+    __slots__ = ('store', 'key', '_meta', 'links', 'loaded', 'exists',
+                 '_shared', '_lazy')
+
     def __init__(self, store, key, meta=NOTLOADED):
         self.store = store
-        self.key = key.lower()
-        self.meta = meta
-        self.links = []
+        self.key = intern_key(key.lower())
+        self._meta = meta
+        self._shared = False
+        self._lazy = None
+        self.links = ()
         self.loaded = meta is not NOTLOADED
         self.exists = False
 
@@ -49,16 +91,52 @@ class Meta(object):
     def name(self):
         return self.key.split('/')[-1]
 
+    @property
+    def meta(self):
+        if self._lazy:
+            self._parse()
+        if self._shared:
+            self._meta = self._meta.copy()
+            self._shared = False
+        return self._meta
+
+    @meta.setter
+    def meta(self, meta):
+        self._meta = meta
+        self._shared = False
+        self._lazy = None
+
+    def get(self, field, default=None):
+        if self._lazy:
+            self._parse()
+        return self._meta.get(field, default)
+
+    def _parse(self):
+        lazy, self._lazy = self._lazy, None
+        if isinstance(lazy, Meta):
+            if lazy._lazy:
+                lazy._parse()
+            self._meta = lazy._meta
+            self._shared = True
+            return
+
+        with open(lazy, 'r') as f:
+            self._meta = load_json(f)
+        self._shared = False
+
     def copy_from(self, meta):
+        # Links are never changed in place, only replaced
         self.store = meta.store
         self.key = meta.key
-        self.meta = meta.meta.copy()
-        self.links = meta.links[:]
+        self._meta = meta._meta
+        self._shared = True
+        self._lazy = meta._lazy and meta
+        self.links = meta.links
         self.loaded = meta.loaded
         self.exists = meta.exists
 
     def rename(self, key):
-        self.key = key
+        self.key = intern_key(key)
 
     def get_path(self):
         return self.store.get_path(self.key)
@@ -81,13 +159,15 @@ class Meta(object):
             if meta == link:
                 return True
 
+    def tokens(self):
+        return set(i.lower() for i in re.split(
+            '\W+', '%s %s' % (self.name, self.get('description', ''))))
+
     def match_keywords(self, keywords):
         if not isinstance(keywords, (tuple, list, set)):
             keywords = [keywords]
 
-        _keywords = [i.lower() for i in re.split(
-            '\W+', '%s %s' % (self.name, self.meta.get('description', '')))]
-        return len(set(keywords) & set(_keywords)) > 0
+        return len(set(keywords) & self.tokens()) > 0
 
     def match_patterns(self, patterns):
         if not isinstance(patterns, (tuple, list, set)):
@@ -101,18 +181,32 @@ class Meta(object):
 
 
 class MetaStore(object):
-    def __init__(self, name, root_path, linked_stores=[]):
+    def __init__(self, name, root_path, linked_stores=[], cache_dir=None):
         self.root = root_path
+        self._norm_root = path.normpath(root_path)
         self.name = name
         self.meta_name = '__meta__.json'
         self.linked_stores = linked_stores
         self.backlinked_stores = []
         self.template = {}  # Meta data template
         self.listeners = []
+        self.cache_dir = cache_dir
+        self.link_index = None
+        self.tombstones = None
+        self._pending = None  # Meta saves deferred by batch()
+        self._batch_depth = 0
+        self.stats = Counter()  # Cache hits and misses of the cached stores
 
         for s in linked_stores:
             s.add_backlinked_store(self)
 
+        if linked_stores:
+            # Kept in memory only without a cache_dir
+            self.link_index = LinkIndex(self, self.cache_path('links'))
+        self.token_index = TokenIndex(self, self.cache_path('tokens'))
+        if cache_dir:
+            self.tombstones = TombstoneLog(self, self.cache_path('tombstones'))
+
     def __str__(self):
         return self.name
 
@@ -129,36 +223,84 @@ class MetaStore(object):
         for cb in self.listeners:
             cb(ev, **kwargs)
 
+    def flush(self):
+        self.broadcast('flush')
+
+    def begin_batch(self):
+        self._batch_depth += 1
+        if self._pending is None:
+            self._pending = {}
+
+    def commit_batch(self):
+        self._batch_depth -= 1
+        if self._batch_depth > 0:
+            return
+
+        pending, self._pending = self._pending, None
+        for key in sorted(pending):
+            meta = pending[key]
+            if path.isdir(meta.get_path()):  # removed in the meantime
+                self.save_meta(meta)
+
+    @contextmanager
+    def batch(self):
+        # Saves of existing keys are buffered and each dirty key is written
+        # once when the outermost batch ends
+        self.begin_batch()
+        try:
+            yield self
+        finally:
+            self.commit_batch()
+
     def get_path(self, key):
         return path.join(self.root, key)
 
-    def get(self, key):
+    def cache_path(self, name):
+        if not self.cache_dir:
+            return None
+        return path.join(self.cache_dir, '%s.%s' % (
+            path.basename(path.normpath(self.root)), name))
+
+    def get(self, key, level=LOAD_LINKS):
         m = Meta(self, key.lower())
-        self.load_meta(m)
+        self.load_meta(m, level)
         return m
 
-    def load_meta(self, meta):
-        meta.loaded = True
+    def load_meta(self, meta, level=LOAD_LINKS):
+        pending = self._pending and self._pending.get(meta.key, None)
         p = meta.get_path()
+        if level == LOAD_KEY:
+            # Not loaded, a later load() reads the rest
+            meta.exists = bool(pending) or path.isfile(
+                path.join(p, self.meta_name))
+            return meta.exists
+
+        meta.loaded = True
         if not path.isdir(p):
             return False
 
-        _meta = {}
+        lazy = None
         links = []
         for fn in sorted(os.listdir(p)):
             fp = path.join(p, fn)
             if fn == self.meta_name:
-                with open(fp, 'r') as f:
-                    meta.exists = True
-                    _meta.update(json.load(f))
+                meta.exists = True
+                lazy = fp
             if path.islink(fp):
                 link = self.get_linked(fp)
                 if link:
                     links.append(link)
                 else:
                     print '%s is a symlink but not pointing to another store' % fp
-        meta.meta = _meta
-        meta.links = links
+        if pending:
+            meta.exists = True
+            meta.meta = pending.meta.copy()
+        else:
+            meta.meta = {}
+            meta._lazy = lazy
+            if lazy and level == LOAD_FULL:
+                meta._parse()
+        meta.links = tuple(links)
         return True
 
     def save_meta(self, meta):
@@ -166,27 +308,53 @@ class MetaStore(object):
             raise Error("Meta should be loaded before saving: %s" % meta)
 
         p = meta.get_path()
+        # Only keys already on disk are buffered. A new one, like the target
+        # of a rename, is written through so it outlives what comes next.
+        if self._pending is not None and meta.exists and path.isdir(p):
+            pending = Meta(self, meta.key, meta.meta.copy())
+            pending.exists = True
+            self._pending[meta.key] = pending
+            return True
 
         try:
             os.makedirs(p)
         except:
             pass
 
+        # Parsed before the file is truncated, if not yet
+        data = meta.meta
         fn = path.join(p, self.meta_name)
         with open(fn, 'w') as f:
-            json_dump(meta.meta, f)
+            json_dump(data, f)
         meta.exists = True
 
+        self.broadcast('save_meta', key=meta.key, meta=meta)
+
         return True
 
     def get_or_create(self, key, meta={}):
         key = key.lower()
-        ret = self.get(key)
+        ret = self.get(key, LOAD_KEY)
         if ret is None or not ret.exists:
             self.add_key(key, meta)
         return meta
 
     def get_linked(self, lpath):
+        # Links are written by add_link as paths relative to the key dir, so
+        # one readlink and some path arithmetic tell where they point to.
+        # Keys are never symlinked dirs themselves (keys() doesn't follow
+        # them), which is what would make it differ from realpath.
+        p = self.resolve_link(lpath)
+        if p:
+            for s in self.linked_stores:
+                key = s.key_from_path(p)
+                if key:
+                    return s.link_meta(key)
+
+        return self.get_linked_realpath(lpath)
+
+    def get_linked_realpath(self, lpath):
+        # For the links made by hand, or through a symlinked root
         p = path.realpath(lpath)
         for s in self.linked_stores:
             if s.is_in_store(p):
@@ -194,6 +362,23 @@ class MetaStore(object):
 
         return None
 
+    def resolve_link(self, lpath):
+        try:
+            target = os.readlink(lpath)
+        except OSError:
+            return None
+        return path.normpath(path.join(path.dirname(lpath), target))
+
+    def key_from_path(self, p):
+        # The key of a normalized path in the store, None if it's not in it
+        root = self._norm_root
+        if path.isabs(p) != path.isabs(root):
+            p = path.abspath(p)
+            root = path.abspath(root)
+        if not p.startswith(root + '/'):
+            return None
+        return p[len(root) + 1:]
+
     def is_in_store(self, p):
         tmp = path.relpath(p, self.root)
         if tmp.startswith('../'):
@@ -204,8 +389,11 @@ class MetaStore(object):
     def meta_from_link(self, lpath):
         p = path.realpath(lpath)
         key = path.relpath(p, self.root)
-        key = key.lower()
-        return Meta(self, key)
+        return self.link_meta(key)
+
+    def link_meta(self, key):
+        # The Meta used as a link to key by the backlinked stores
+        return Meta(self, key.lower())
 
     def add_link(self, key, lpath, name=None, create=False):
         key = key.lower()
@@ -225,7 +413,7 @@ class MetaStore(object):
         os.symlink(lpath, p)
         self.update_timestamp(key)
 
-        self.broadcast('add_link')
+        self.broadcast('add_link', key=key, link=self.get_linked(p))
         return True
 
     def remove_link(self, key, lpath):
@@ -237,9 +425,10 @@ class MetaStore(object):
         p = self.get_path(key)
         p = path.join(p, name)
         if path.islink(p):
+            link = self.get_linked(p)
             os.unlink(p)
             self.update_timestamp(key)
-            self.broadcast('remove_link')
+            self.broadcast('remove_link', key=key, link=link)
             return True
         elif not path.exists(p):
             return True
@@ -261,7 +450,7 @@ class MetaStore(object):
         m = Meta(self, key, _meta)
         m.save()
 
-        self.broadcast('add_key')
+        self.broadcast('add_key', key=key)
 
         return m
 
@@ -281,7 +470,10 @@ class MetaStore(object):
         if m.exists:
             shutil.rmtree(m.get_path())
 
-        self.broadcast('remove_key')
+        if self._pending:
+            self._pending.pop(key, None)
+
+        self.broadcast('remove_key', key=key)
 
         return True
 
@@ -317,12 +509,23 @@ class MetaStore(object):
 
         shutil.rmtree(m.get_path())
 
-        self.broadcast('rename_key')
+        if self._pending:
+            self._pending.pop(key, None)
+
+        self.broadcast('rename_key', key=key, new_key=new_key)
 
         return True
 
+    def changed(self, key):
+        # key was edited on disk, behind the back of the store
+        m = self.get(key)
+        if m.exists:
+            self.broadcast('save_meta', key=m.key, meta=m)
+
     def update_timestamp(self, key):
-        meta = self.get(key)
+        meta = self._pending and self._pending.get(key, None)
+        if not meta:
+            meta = self.get(key)
         if not meta.exists:
             return False
 
@@ -334,7 +537,19 @@ class MetaStore(object):
             if self.meta_name in filenames:
                 yield path.relpath(dirpath, self.root)
 
+    def rescan(self):
+        # Finds the changes made by other means than tagg, a git pull say,
+        # which the indexes don't see otherwise
+        if self.link_index:
+            self.link_index.rescan()
+        self.token_index.rescan()
+
     def find_links(self, links):
+        if self.link_index:
+            for key in self.link_index.find(links):
+                yield key
+            return
+
         link_names = set(i.key.split('/')[-1] for i in links)
 
         for dirpath, dirnames, filenames in os.walk(self.root):
@@ -350,17 +565,22 @@ class MetaStore(object):
                 if ret:
                     yield path.relpath(dirpath, self.root)
 
-    def find_keywords(self, keywords):
-        for key in self.keys():
-            m = self.get(key)
-            if m.match_keywords(keywords):
-                yield key
+    def query(self, expr, tagstore):
+        # Sorted keys matching a boolean query of the tags in tagstore, see
+        # tagg.query
+        evaluator = QueryEvaluator(self.link_index, tagstore)
+        return sorted(evaluator.eval(parse_query(expr)))
 
-    def key_hints(self, prefix):
-        p = self.get_path(prefix)
-        if path.isdir(p):
-            return os.listdir(p)
-        return []
+    def removed_since(self, ts):
+        if not self.tombstones:
+            return []
+        return sorted(key for key in self.tombstones.since(ts)
+                      if not self.get(key, LOAD_KEY).exists)
+
+    def find_keywords(self, keywords):
+        # Any of the keywords, all the terms of a keyword joined by +. A term
+        # ending with * is a prefix.
+        return self.token_index.search(keywords)
 
     def link_stats(self):
         stats = Counter()
@@ -444,6 +664,10 @@ class MetaStore(object):
 
                 os.rename(_old, _new)
 
+        if self.link_index:
+            self.link_index.rebuild()
+        self.token_index.rebuild()
+
         if errors:
             raise Error('\n'.join(errors))
 
@@ -455,6 +679,8 @@ class CachedMetaStore(MetaStore):
         super(CachedMetaStore, self).__init__(*args, **kwargs)
         #print >>sys.stderr, 'Loading', self.name
         self._cache = {}
+        self._snapshot = {}  # dir -> [mtime, children, sig, data, links]
+        self._scanned = 0
         self.cache_all()
         #print >>sys.stderr, 'Loaded', self.name
 
@@ -462,6 +688,10 @@ class CachedMetaStore(MetaStore):
         return self._cache.keys()
 
     def cache_all(self):
+        fn = self.cache_path('snapshot.json')
+        if fn:
+            return self.cache_snapshot(fn)
+
         for key in super(CachedMetaStore, self).keys():
             self.cache(key)
 
@@ -469,25 +699,143 @@ class CachedMetaStore(MetaStore):
         key = key.lower()
         meta = Meta(self, key)
         MetaStore.load_meta(self, meta)
+        self.cache_meta(key, meta)
+        return meta
+
+    def cache_meta(self, key, meta):
         if meta.exists:
             self._cache[key] = meta
         elif key in self._cache:
             del self._cache[key]
-        return meta
 
-    def load_meta(self, meta):
+    snapshot_version = 2
+
+    def cache_snapshot(self, fn):
+        # Start from the snapshot of the last run and only rescan the dirs
+        # whose mtime changed since. An unchanged dir has the same children
+        # and links, and an unchanged __meta__.json the same meta, so the
+        # cost is a couple of stat() per dir instead of parsing everything.
+        old = {}
+        created = 0
+        if path.isfile(fn):
+            try:
+                with open(fn, 'r') as f:
+                    data = load_json(f)
+                if data.get('version') == self.snapshot_version:
+                    old = data['dirs']
+                    # mtimes this close to the snapshot may hide later changes
+                    created = data['created'] - 1
+            except ValueError:
+                pass
+
+        if self._scan(old, created):
+            self._dump_snapshot(fn)
+
+    def _dump_snapshot(self, fn):
+        if path.isdir(self.root):
+            atomic_json_dump({
+                'version': self.snapshot_version,
+                'created': self._scanned,
+                'dirs': self._snapshot,
+            }, fn)
+
+    def _scan(self, old, fresh_before):
+        # Caches the keys whose dir changed since old was recorded, and drops
+        # the ones gone. Returns whether anything changed.
+        now = time.time()
+        dirs = {}
+        found = set()
+        changed = False
+        for rel, p, mtime, children, has_meta, rec in scan_dirs(
+                self.root, self.meta_name, old, fresh_before):
+            changed = changed or rec is None
+            sig = None
+            if has_meta:
+                try:
+                    st = os.stat(path.join(p, self.meta_name))
+                    sig = [st.st_mtime, st.st_size]
+                except OSError:
+                    changed = True
+
+            new = dirs[rel] = [mtime, children, sig]
+            if not sig:
+                continue
+
+            key = rel.lower()
+            found.add(key)
+            if rec is not None and rec[2] == sig and sig[0] < fresh_before:
+                new.extend(rec[3:])
+                if key in self._cache:
+                    continue  # Cached already, by the last scan
+                meta = Meta(self, key, rec[3])
+                meta.exists = True
+                meta.links = tuple(self.linked_stores[i].link_meta(k)
+                                   for i, k in rec[4])
+            else:
+                changed = True
+                meta = Meta(self, key)
+                MetaStore.load_meta(self, meta)
+                new.append(meta.meta)
+                new.append([(self.linked_stores.index(i.store), i.key)
+                            for i in meta.links])
+            self.cache_meta(key, meta)
+
+        for key in set(self._cache) - found:
+            self.cache_meta(key, Meta(self, key))
+            changed = True
+
+        self._snapshot = dirs
+        self._scanned = now
+        return changed
+
+    def rescan(self):
+        # Catches up with the changes made since the last scan, by other
+        # processes too
+        fn = self.cache_path('snapshot.json')
+        if self._scan(self._snapshot, self._scanned - 1) and fn:
+            self._dump_snapshot(fn)
+        super(CachedMetaStore, self).rescan()
+
+    def link_meta(self, key):
+        # Shared with the cache, instead of a Meta per link of every repo
+        key = key.lower()
+        m = self._cache.get(key, None)
+        if m is None:
+            m = Meta(self, key)
+        return m
+
+    def load_meta(self, meta, level=LOAD_LINKS):
         m = self._cache.get(meta.key, None)
         if not m:
+            self.stats['cache_misses'] += 1
             m = self.cache(meta.key)
+        else:
+            self.stats['cache_hits'] += 1
 
         if m:
             meta.copy_from(m)
 
         return True
 
+    def save_meta(self, meta):
+        ret = super(CachedMetaStore, self).save_meta(meta)
+        m = self._cache.get(meta.key, None)
+        if ret and m is not None and m is not meta:
+            # For the copies made from now on
+            m.meta = meta.meta.copy()
+        return ret
+
+    def changed(self, key):
+        self.cache(key)
+        super(CachedMetaStore, self).changed(key)
+
+    def full_key(self, key):
+        # The key a cached Meta is found by key with
+        return key
+
     def _key_change_wrapper(func_name):
         def _wrapped(self, key, *args, **kwargs):
-            key = key.lower()
+            key = self.full_key(key.lower())
             obj = super(CachedMetaStore, self)
             func = getattr(obj, func_name)
             ret = func(key, *args, **kwargs)
@@ -499,10 +847,17 @@ class CachedMetaStore(MetaStore):
 
     add_key = _key_change_wrapper('add_key')
     remove_key = _key_change_wrapper('remove_key')
-    rename_key = _key_change_wrapper('rename_key')
     remove_link = _key_change_wrapper('remove_link')
     add_link = _key_change_wrapper('add_link')
 
+    def rename_key(self, key, new_key):
+        key = self.full_key(key.lower())
+        ret = super(CachedMetaStore, self).rename_key(key, new_key)
+        if ret:
+            self.cache(key)
+            self.cache(new_key)
+        return ret
+
 
 class UniqueCachedMetaStore(CachedMetaStore):
     def __init__(self, *args, **kwargs):
@@ -514,9 +869,8 @@ class UniqueCachedMetaStore(CachedMetaStore):
             key = key.split('/')[-1].lower()
         return key
 
-    def cache(self, key):
-        key = key.lower()
-        meta = super(UniqueCachedMetaStore, self).cache(key)
+    def cache_meta(self, key, meta):
+        super(UniqueCachedMetaStore, self).cache_meta(key, meta)
         uk = self.get_unique_key(key)
         if meta.exists:
             self._cache_unique[uk] = meta
@@ -525,15 +879,22 @@ class UniqueCachedMetaStore(CachedMetaStore):
             if tmp.key == key:
                 del self._cache_unique[uk]
 
-        return meta
+    def full_key(self, key):
+        if key not in self._cache and self.get_unique_key(key) == key:
+            m = self._cache_unique.get(key, None)
+            if m:
+                return m.key
+        return key
 
-    def load_meta(self, meta):
+    def load_meta(self, meta, level=LOAD_LINKS):
         m = self._cache.get(meta.key, None)
+        if not m and self.get_unique_key(meta.key) == meta.key:
+            m = self._cache_unique.get(meta.key, None)
         if not m:
-            if self.get_unique_key(meta.key) == meta.key:
-                m = self._cache_unique.get(meta.key, None)
-            if not m:
-                m = self.cache(meta.key)
+            self.stats['cache_misses'] += 1
+            m = self.cache(meta.key)
+        else:
+            self.stats['cache_hits'] += 1
 
         if m:
             meta.copy_from(m)
@@ -552,14 +913,6 @@ class UniqueCachedMetaStore(CachedMetaStore):
 
         return super(UniqueCachedMetaStore, self).add_key(key, meta)
 
-    def key_hints(self, prefix):
-        ret = []
-        if not prefix:
-            ret = self._cache_unique.keys()
-
-        ret += super(UniqueCachedMetaStore, self).key_hints(prefix)
-        return ret
-
     def validate(self):
         keys = [(self.get_unique_key(i), i) for i in self._cache.keys()]
         c = Counter([i[0] for i in keys])
@@ -578,12 +931,78 @@ class UniqueCachedMetaStore(CachedMetaStore):
 
 
 class GithubMetaStore(MetaStore):
+    refresh_fields = ('fork', 'language', 'description')
+
+    def __init__(self, *args, **kwargs):
+        super(GithubMetaStore, self).__init__(*args, **kwargs)
+        self._github = None
+
+    def github(self, username=''):
+        cache_dir = self.cache_dir and path.join(self.cache_dir, 'http')
+        if username:
+            return GithubHelper(username, cache_dir=cache_dir)
+
+        if not self._github:
+            self._github = GithubHelper(cache_dir=cache_dir)
+        return self._github
+
     def add_key(self, key, meta={}):
         key = key.lower()
         if not meta:
             # fetch meta
             print >> sys.stderr, 'Fetching meta from Github: %s' % key
-            gh = GithubHelper()
+            gh = self.github()
             data = gh.get_repo(key)
             meta = gh.compact(data)
         return super(GithubMetaStore, self).add_key(key, meta)
+
+    def add_keys(self, keys):
+        # Adds many repos, fetching the meta of the missing ones together
+        missing = []
+        seen = set()
+        for key in keys:
+            key = key.lower()
+            fn = path.join(self.get_path(key), self.meta_name)
+            if key not in seen and not path.isfile(fn):
+                seen.add(key)
+                missing.append(key)
+
+        if not missing:
+            return []
+
+        print >> sys.stderr, 'Fetching meta from Github: %d repos' % len(
+            missing)
+        gh = self.github()
+        added = []
+        for key, data in zip(missing, gh.get_repos(missing)):
+            if data is None:
+                continue
+            m = super(GithubMetaStore, self).add_key(key, gh.compact(data))
+            if m:
+                added.append(m)
+        return added
+
+    def refresh(self, keys=None):
+        # Fetches the meta of the repos again and saves the ones which
+        # changed. Returns (key, changed fields) for each of them.
+        keys = sorted(set(i.lower() for i in (
+            self.keys() if keys is None else keys)))
+        gh = self.github()
+        changed = []
+        for key, data in izip(keys, gh.get_repos(keys)):
+            if data is None:
+                continue
+            m = self.get(key)
+            if not m.exists:
+                continue
+            meta = gh.compact(data)
+            fields = [i for i in self.refresh_fields
+                      if m.get(i, None) != meta[i]]
+            if not fields:
+                continue
+            for i in fields:
+                m.meta[i] = meta[i]
+            m.meta['updated_at'] = timestamp()
+            m.save()
+            changed.append((key, fields))
+        return changed
@@ -4,10 +4,13 @@ import json
 import re
 import argparse
 import os
+import multiprocessing
 from collections import Counter
+from contextlib import contextmanager
 from itertools import imap
 
 from . import cli as _tag
+from .instrument import profiling
 
 
 class ImmediateActions(object):
@@ -22,6 +25,9 @@ class ImmediateActions(object):
     def get_repo(self, store, key):
         return store.get(key)
 
+    def batch(self, store):
+        return store.batch()
+
     def tag_repo(self, repostore, repo, tag):
         if not self.interactive or self.cs.repo_confirm('Tag %s as %s' %
                                                         (repo, tag), repo):
@@ -74,12 +80,23 @@ class SuggestActions(object):
 
         return t
 
+    @contextmanager
+    def batch(self, store):
+        # Nothing is written
+        yield store
+
+    def add_tag_action(self, action):
+        self.tag_actions.append(action)
+
+    def add_repo_action(self, action):
+        self.repo_actions.append(action)
+
     def tag_repo(self, repostore, repo, tag):
-        self.repo_actions.append('repos\ttag\t%s\t%s' % (repo.key, tag.key))
+        self.add_repo_action('repos\ttag\t%s\t%s' % (repo.key, tag.key))
         return True
 
     def new_tag(self, tagstore, key, meta={}):
-        self.tag_actions.append('tags\tadd\t%s\t%s' % (key, json.dumps(meta)))
+        self.add_tag_action('tags\tadd\t%s\t%s' % (key, json.dumps(meta)))
         # Fake tag
         tag = _tag.Meta(tagstore, key, meta)
         tag.exists = True
@@ -87,8 +104,7 @@ class SuggestActions(object):
         return tag
 
     def new_repo(self, repostore, key, meta={}):
-        self.repo_actions.append('repos\tadd\t%s\t%s' %
-                                 (key, json.dumps(meta)))
+        self.add_repo_action('repos\tadd\t%s\t%s' % (key, json.dumps(meta)))
         # Fake tag
         repo = _tag.Meta(repostore, key, meta)
         repo.exists = True
@@ -104,13 +120,123 @@ class SuggestActions(object):
         self.new_comment('repos\ttag\t%s\t\t\t' % repo.key)
 
     def new_comment(self, msg):
-        self.repo_actions.append('# ' + msg)
+        self.add_repo_action('# ' + msg)
+
+    def merge(self, tag_actions, repo_actions):
+        # Tags suggested by several workers are only kept once
+        seen = set(self.tag_actions)
+        for i in tag_actions:
+            if i not in seen:
+                seen.add(i)
+                self.add_tag_action(i)
+        for i in repo_actions:
+            self.add_repo_action(i)
 
     def on_finish(self, c):
         _tag.list_print(self.tag_actions)
         _tag.list_print(self.repo_actions)
 
 
+class StreamActions(SuggestActions):
+    # Prints the suggested cmds as they are made instead of when done, so a
+    # tagg they are piped to applies them while tagging goes on. A tag is
+    # printed when it's suggested, before the cmds of the repos tagged with
+    # it. Only the tag cmds are kept, to not suggest a tag twice.
+    def __init__(self, out=None):
+        super(StreamActions, self).__init__()
+        self.out = out or sys.stdout
+
+    def emit(self, action):
+        print >> self.out, action
+        self.out.flush()
+
+    def add_tag_action(self, action):
+        self.tag_actions.append(action)
+        self.emit(action)
+
+    def add_repo_action(self, action):
+        self.emit(action)
+
+    def on_finish(self, c):
+        pass
+
+
+class PatternSet(object):
+    # Fuses regexes into as few as possible: every pattern becomes an optional
+    # group inside its own lookahead, ex. (?=(p1)?)(?=(p2)?), so a single
+    # match() at the start of the string sets the group of each pattern which
+    # would have matched there on its own. Patterns that can't be embedded
+    # (backreferences, inline flags, too many groups) are tried on their own.
+    max_groups = 99  # sre supports at most 100 groups per regex
+    unsafe = re.compile(r'\\\d|\(\?P[=<]|\(\?\(|\(\?[iLmsux]+\)')
+
+    def __init__(self, patterns):
+        self.chunks = []
+        self.fallback = []
+        default_flags = re.compile('').flags
+        parts = []
+        groups = []
+        for value, p in patterns:
+            if p.groups + 1 > self.max_groups or p.flags != default_flags or \
+                    self.unsafe.search(p.pattern):
+                self.fallback.append((value, p))
+                continue
+
+            n = sum(i[2] for i in groups)
+            if n + p.groups + 1 > self.max_groups:
+                self._add_chunk(parts, groups)
+                parts, groups, n = [], [], 0
+            parts.append('(?=(%s)?)' % p.pattern)
+            groups.append((n + 1, value, p.groups + 1))
+        self._add_chunk(parts, groups)
+
+    def _add_chunk(self, parts, groups):
+        if parts:
+            self.chunks.append((re.compile(''.join(parts)),
+                                [(i[0], i[1]) for i in groups]))
+
+    def match(self, s):
+        ret = []
+        for regex, groups in self.chunks:
+            found = regex.match(s).groups()
+            if found.count(None) == len(found):
+                continue  # The common case, nothing matched
+            ret.extend(value for i, value in groups
+                       if found[i - 1] is not None)
+
+        for value, p in self.fallback:
+            if p.match(s):
+                ret.append(value)
+
+        return ret
+
+
+class KeywordMatcher(object):
+    # Maps each plain word of the keyword rules to the rules using it, so a
+    # repo is tokenized once and only its own tokens are looked up. Matches
+    # are returned in the order of the rules.
+    def __init__(self, keywords):
+        self.rules = []
+        self.words = {}
+        patterns = []
+        for i, (tag_name, v) in enumerate(sorted(keywords.iteritems())):
+            self.rules.append((tag_name, v))
+            for word in v['plainwords']:
+                self.words.setdefault(word, []).append(i)
+            for p in v['patterns']:
+                patterns.append((i, p))
+        self.patterns = PatternSet(patterns)
+
+    def match(self, repo):
+        matched = set()
+        for token in repo.tokens():
+            matched.update(self.words.get(token, ()))
+
+        matched.update(self.patterns.match(repo.name))
+
+        return [self.rules[i] for i in sorted(matched)]
+
+
 class AutoTagger(object):
     def __init__(self, tagstore, repostore, actions):
         self.tag_language = False
@@ -154,35 +280,27 @@ class AutoTagger(object):
             return False
 
         # Original
-        fork = repo.meta.get('fork', None)
+        fork = repo.get('fork', None)
         if self.tag_original and fork is False:
             tagged = _tag_helper('general/original') or tagged
 
         # Language
-        language = repo.meta.get('language', '')
+        language = repo.get('language', '')
         if self.tag_language and language:
             tag_name = "language/" + self.normalize_tag_name(language)
             tagged = _tag_helper(tag_name, True) or tagged
 
         # Keywords
-        for tag_name, v in definitions.get('keywords', {}).iteritems():
+        for tag_name, v in definitions['matcher'].match(repo):
             if v['tag'].key in tagged_tags or repo.has_link(v['tag']):
                 continue
 
-            if v['plainwords'] and repo.match_keywords(v['plainwords']):
-                if self.actions.tag_repo(self.repostore, repo, v['tag']):
-                    c['new_link'] += 1
-                    tagged = True
-                continue
-
-            if v['patterns'] and repo.match_patterns(v['patterns']):
-                if self.actions.tag_repo(self.repostore, repo, v['tag']):
-                    c['new_link'] += 1
-                    tagged = True
-                continue
+            if self.actions.tag_repo(self.repostore, repo, v['tag']):
+                c['new_link'] += 1
+                tagged = True
 
         # Brands
-        for tag_name, v in definitions.get('brands', {}).iteritems():
+        for tag_name, v in sorted(definitions.get('brands', {}).iteritems()):
             if account in v:
                 if tag_name.find('/') == -1:
                     tag_name = 'brand/%s' % tag_name
@@ -198,7 +316,7 @@ class AutoTagger(object):
 
     def compile_definitions(self, data, counter):
         keywords = {}
-        for tag_name, v in data.get('keywords', {}).iteritems():
+        for tag_name, v in sorted(data.get('keywords', {}).iteritems()):
             patterns = []
             plainwords = []
             if tag_name.find('/') == -1:
@@ -224,6 +342,7 @@ class AutoTagger(object):
             }
         compiled = data.copy()
         compiled['keywords'] = keywords
+        compiled['matcher'] = KeywordMatcher(keywords)
         return compiled
 
     def autotag(self, data, keys):
@@ -232,13 +351,49 @@ class AutoTagger(object):
 
         print >> sys.stderr, 'Total rules defined in data:', len(
             defs.get('keywords', {})) + len(defs.get('brands', {}))
-        for key in keys:
-            repo = self.actions.get_repo(self.repostore, key)
-            c.update(self.autotag_repo(repo, defs))
+        self.autotag_keys(defs, keys, c)
 
         self.actions.on_finish(c)
         return c
 
+    def autotag_keys(self, defs, keys, c):
+        for key in keys:
+            # All the tags of a repo are written at once, and nothing is
+            # held past it
+            with self.actions.batch(self.repostore):
+                repo = self.actions.get_repo(self.repostore, key)
+                c.update(self.autotag_repo(repo, defs))
+
+    def parallel_autotag(self, data_dir, data, keys, jobs):
+        # Only for suggestions. Sorted keys are cut in contiguous shards,
+        # several per worker to even the load, and the results are merged
+        # in shard order so the output is the same as a serial run on them.
+        keys = sorted(keys)
+        size = max(1, -(-len(keys) // (jobs * 4)))
+        options = {
+            'tag_language': self.tag_language,
+            'tag_original': self.tag_original,
+            'show_skipped_repos': self.actions.show_skipped_repos,
+        }
+        shards = [keys[i:i + size] for i in xrange(0, len(keys), size)]
+
+        print >> sys.stderr, 'Tagging %d repos in %d shards with %d jobs' % (
+            len(keys), len(shards), jobs)
+        c = Counter()
+        pool = multiprocessing.Pool(jobs, _init_worker,
+                                    (data_dir, data, options))
+        try:
+            for tag_actions, repo_actions, counter in pool.imap(
+                    _autotag_shard, shards):
+                self.actions.merge(tag_actions, repo_actions)
+                c.update(counter)
+        finally:
+            pool.terminate()
+
+        c['new_tag'] = len(self.actions.tag_actions)
+        self.actions.on_finish(c)
+        return c
+
     def prepare_json_repos(self, repos):
         keys = set()
         for repojson in repos:
@@ -254,6 +409,40 @@ class AutoTagger(object):
         return keys
 
 
+# Targets and compiled definitions of a parallel_autotag worker, set up once
+# by _init_worker and used for all the shards it's given
+_worker = None
+
+
+def _init_worker(data_dir, data, options):
+    global _worker
+    targets = _tag.get_targets(data_dir)
+    actions = SuggestActions()
+    actions.show_skipped_repos = options['show_skipped_repos']
+    tagger = AutoTagger(targets['tags'], targets['repos'], actions)
+    tagger.tag_language = options['tag_language']
+    tagger.tag_original = options['tag_original']
+
+    c = Counter()
+    defs = tagger.compile_definitions(data, c)
+    _worker = (tagger, defs, actions, c)
+
+
+def _autotag_shard(keys):
+    tagger, defs, init_actions, init_counter = _worker
+    # Every shard starts from the tags suggested by compile_definitions, as
+    # if it were a run of its own
+    actions = SuggestActions()
+    actions.show_skipped_repos = init_actions.show_skipped_repos
+    actions.tag_actions = list(init_actions.tag_actions)
+    actions.suggested_tags = dict(init_actions.suggested_tags)
+    tagger.actions = actions
+
+    c = Counter(init_counter)
+    tagger.autotag_keys(defs, keys, c)
+    return actions.tag_actions, actions.repo_actions, c
+
+
 def main():
     tmp = os.path.dirname(__file__)
     default_def = os.path.join(tmp, 'default_defs.json')
@@ -314,6 +503,22 @@ def main():
         action='store_true',
         help='Tag all existing repos in the data dir',
         default=False)
+    parser.add_argument(
+        '--refresh',
+        action='store_true',
+        default=False,
+        help='Fetch the meta of all existing repos, or of repo_name, again and tag the ones which changed')
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=1,
+        help='Number of processes to tag all existing repos with. Can\'t be used with -r')
+    parser.add_argument(
+        '--stream',
+        action='store_true',
+        default=False,
+        help='Print commands as they are suggested instead of all at the end, to pipe them to tagg while tagging goes on')
+    _tag.add_profile_args(parser)
     parser.add_argument(
         'repo_name',
         nargs='?',
@@ -321,9 +526,15 @@ def main():
 
     args = parser.parse_args()
     actions = SuggestActions()
+    if args.stream:
+        actions = StreamActions()
     if args.run:
         actions = ImmediateActions(args.interactive)
 
+    if args.jobs > 1 and args.run:
+        print >> sys.stderr, "--jobs only works when printing commands. Remove -r"
+        sys.exit(1)
+
     if not args.datafile and not args.tag_language and not args.tag_original:
         parser.print_help()
         print >> sys.stderr, "There's nothing to do. At least remove one of --no-language, --no-original or provide a datafile"
@@ -336,7 +547,13 @@ def main():
             print >> sys.stderr, "Start tagging repos with tags defined in", args.datafile
             data = json.load(f)
 
-    targets = _tag.get_targets(args.data_dir)
+    with profiling(args.profile, args.profile_dump) as profiler:
+        run(args, data, actions, profiler)
+
+
+def run(args, data, actions, profiler):
+    with profiler.cmd('startup'):
+        targets = _tag.get_targets(args.data_dir)
     if not os.path.exists(targets['tags'].root) and not os.path.exists(
             targets['repos'].root) and not args.force:
         print >> sys.stderr, "%s doesn't seem to have any data in it. Use --force to operate in it." % args.data_dir
@@ -346,40 +563,59 @@ def main():
     tagger.tag_language = args.tag_language
     tagger.tag_original = args.tag_original
 
-    if args.github_account:
-        print >> sys.stderr, "Fetching my repos"
-        gh = _tag.GithubHelper(args.github_account)
-        repos = gh.get_mine()
-        if args.starred:
-            repos += gh.get_starred()
-
-        repos = imap(gh.compact, repos)
-        keys = tagger.prepare_json_repos(repos)
-        print >> sys.stderr, tagger.autotag(data, keys)
-        print >> sys.stderr, 'Done'
-    elif args.top1k:
-        print >> sys.stderr, "Fetching Github top1k"
-        gh = _tag.GithubHelper()
-        repos = gh.get_top1k()
-        if args.starred:
-            repos += gh.get_starred()
-
-        repos = imap(gh.compact, repos)
-        keys = tagger.prepare_json_repos(repos)
-        print >> sys.stderr, tagger.autotag(data, keys)
-        print >> sys.stderr, 'Done'
-    elif args.starred:
-        print >> sys.stderr, "No github account is provided. Add -g"
-    elif args.all:
-        actions.show_skipped_repos = False
-        print >> sys.stderr, tagger.autotag(data, targets['repos'].keys())
-        print >> sys.stderr, 'Done'
-    elif args.repo_name:
-        #actions.show_skipped_repos = False
-        print >> sys.stderr, tagger.autotag(data, [args.repo_name])
-    else:
-        print >> sys.stderr, "There's nothing to do. At least use one of -g, -a, --top1k or provide a repo_name"
-        sys.exit(1)
+    with profiler.cmd('autotag'):
+        if args.github_account:
+            print >> sys.stderr, "Fetching my repos"
+            gh = targets['repos'].github(args.github_account)
+            repos = gh.get_mine()
+            if args.starred:
+                repos += gh.get_starred()
+
+            repos = imap(gh.compact, repos)
+            keys = tagger.prepare_json_repos(repos)
+            print >> sys.stderr, 'Github quota:', gh.limiter.metrics()
+            print >> sys.stderr, tagger.autotag(data, keys)
+            print >> sys.stderr, 'Done'
+        elif args.top1k:
+            print >> sys.stderr, "Fetching Github top1k"
+            gh = targets['repos'].github()
+            repos = gh.get_top1k()
+            if args.starred:
+                repos += gh.get_starred()
+
+            repos = imap(gh.compact, repos)
+            keys = tagger.prepare_json_repos(repos)
+            print >> sys.stderr, 'Github quota:', gh.limiter.metrics()
+            print >> sys.stderr, tagger.autotag(data, keys)
+            print >> sys.stderr, 'Done'
+        elif args.starred:
+            print >> sys.stderr, "No github account is provided. Add -g"
+        elif args.refresh:
+            keys = args.repo_name and [args.repo_name] or None
+            changed = targets['repos'].refresh(keys)
+            print >> sys.stderr, 'Github quota:', targets[
+                'repos'].github().limiter.metrics()
+            print >> sys.stderr, '%d repos changed' % len(changed)
+            print >> sys.stderr, tagger.autotag(data, [i[0] for i in changed])
+            print >> sys.stderr, 'Done'
+        elif args.all and args.jobs > 1:
+            actions.show_skipped_repos = False
+            print >> sys.stderr, tagger.parallel_autotag(
+                args.data_dir, data, targets['repos'].keys(), args.jobs)
+            print >> sys.stderr, 'Done'
+        elif args.all:
+            actions.show_skipped_repos = False
+            print >> sys.stderr, tagger.autotag(data, targets['repos'].keys())
+            print >> sys.stderr, 'Done'
+        elif args.repo_name:
+            #actions.show_skipped_repos = False
+            print >> sys.stderr, tagger.autotag(data, [args.repo_name])
+        else:
+            print >> sys.stderr, "There's nothing to do. At least use one of -g, -a, --top1k, --refresh or provide a repo_name"
+            sys.exit(1)
+
+    with profiler.cmd('flush'):
+        _tag.flush_targets(targets)
 
 
 if __name__ == '__main__':
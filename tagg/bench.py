@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+import os
+import sys
+import json
+import re
+import random
+import shutil
+import string
+import subprocess
+import tempfile
+import time
+import argparse
+import os.path as path
+
+from . import cli as _tag
+from .autotag import PatternSet, AutoTagger, SuggestActions
+
+
+def timeit(func, repeat=3):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def random_word(rnd, min_len=2, max_len=8):
+    return ''.join(rnd.choice(string.ascii_lowercase)
+                   for i in xrange(rnd.randint(min_len, max_len)))
+
+
+def bench_patterns(rules, names, seed=0):
+    rnd = random.Random(seed)
+    templates = [r'^%s', r'^%s[\-]?', r'%s$', r'^%s(js|py)?$', r'^(go|py)-?%s']
+    patterns = []
+    for i in xrange(rules):
+        p = rnd.choice(templates) % random_word(rnd)
+        patterns.append((i, re.compile(p)))
+    words = [random_word(rnd) for i in xrange(rules)]
+    samples = ['%s%s' % (rnd.choice(words), rnd.choice(['', '-js', 'py']))
+               for i in xrange(names)]
+
+    def loop():
+        for s in samples:
+            [i for i, p in patterns if p.match(s)]
+
+    pset = PatternSet(patterns)
+
+    def fused():
+        for s in samples:
+            pset.match(s)
+
+    # Both must agree before their timings mean anything
+    for s in samples:
+        assert sorted(pset.match(s)) == [i for i, p in patterns if p.match(s)]
+
+    ret = {
+        'bench': 'patterns',
+        'rules': rules,
+        'names': names,
+        'loop': timeit(loop),
+        'fused': timeit(fused),
+    }
+    ret['speedup'] = ret['loop'] / max(ret['fused'], 1e-9)
+    return ret
+
+
+# Synthetic data dirs
+def default_definitions():
+    fn = path.join(path.dirname(__file__), 'default_defs.json')
+    with open(fn, 'r') as f:
+        return json.load(f)
+
+
+def generate(data_dir, repos, tags, links, seed=0):
+    # Writes a data dir with the layout of tag-github: tags/domain/name and
+    # repos/owner/name dirs with a __meta__.json each, and the links of a
+    # repo as symlinks to tag dirs. links is the average number per repo.
+    rnd = random.Random(seed)
+    defs = default_definitions()
+    words = sorted(set(w for v in defs['keywords'].values() for w in v
+                       if not w.startswith('/')))
+    words = sorted(set(words + [random_word(rnd)
+                                for i in xrange(len(words))]))
+    languages = ['Python', 'JavaScript', 'Go', 'C++', 'Ruby', 'Java', None]
+    domains = ['general', 'language', 'brand', 'platform']
+    now = _tag.timestamp()
+
+    def write_meta(p, meta):
+        os.makedirs(p)
+        with open(path.join(p, '__meta__.json'), 'w') as f:
+            _tag.json_dump(meta, f)
+
+    tag_keys = []
+    names = set()
+    while len(tag_keys) < tags:
+        name = rnd.choice(words) if len(names) < len(words) else \
+            random_word(rnd, 4, 12)
+        if name in names:
+            continue
+        names.add(name)
+        key = '%s/%s' % (rnd.choice(domains), name)
+        write_meta(path.join(data_dir, 'tags', key),
+                   {'created_at': now, 'updated_at': now})
+        tag_keys.append(key)
+
+    owners = [random_word(rnd, 3, 10) for i in xrange(max(1, repos / 5))]
+    repo_keys = set()
+    while len(repo_keys) < repos:
+        key = '%s/%s%d' % (rnd.choice(owners), rnd.choice(words),
+                           rnd.randint(0, repos))
+        if key in repo_keys:
+            continue
+        repo_keys.add(key)
+        p = path.join(data_dir, 'repos', key)
+        write_meta(p, {
+            'created_at': now,
+            'updated_at': now,
+            'fork': rnd.random() < 0.2,
+            'full_name': key,
+            'language': rnd.choice(languages),
+            'description': ' '.join(rnd.choice(words)
+                                    for i in xrange(rnd.randint(0, 12))),
+        })
+        n = min(len(tag_keys), rnd.randint(0, 2 * links))
+        for tag in rnd.sample(tag_keys, n):
+            target = path.join(data_dir, 'tags', tag)
+            os.symlink(path.relpath(target, p),
+                       path.join(p, path.basename(tag)))
+
+    return {'repos': repos, 'tags': tags, 'links': links,
+            'tag_keys': tag_keys, 'repo_keys': sorted(repo_keys),
+            'words': words}
+
+
+class Silenced(object):
+    # Sends what the cmds print to /dev/null while timing them
+    def __enter__(self):
+        self.stdout = sys.stdout
+        self.stderr = sys.stderr
+        sys.stdout = sys.stderr = open(os.devnull, 'w')
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        sys.stderr = self.stderr
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=path.dirname(__file__),
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_data_dir(data_dir, info, repeat=1):
+    tag = info['tag_keys'][0]
+    word = info['words'][0]
+    cmds = [
+        ('tags show', ('tags', 'show', tag)),
+        ('tags list', ('tags', 'list')),
+        ('repos list', ('repos', 'list')),
+        ('repos links', ('repos', 'links', tag)),
+        ('repos find', ('repos', 'find', word)),
+        ('repos link_stats', ('repos', 'link_stats')),
+        ('tags validate', ('tags', 'validate')),
+        ('repos validate', ('repos', 'validate')),
+        ('export', ('export', None)),
+        ('export jsonl', ('export', None, None, None, None, 'jsonl')),
+    ]
+
+    # A repo with links, one of them, and a tag it doesn't have
+    for repo in info['repo_keys']:
+        p = path.join(data_dir, 'repos', repo)
+        linked = [i for i in os.listdir(p) if path.islink(path.join(p, i))]
+        if linked:
+            break
+    untagged = [i for i in info['tag_keys']
+                if path.basename(i) not in linked][0]
+    new_repo = json.dumps({'description': word})
+    writes = [
+        ('tags add', ('tags', 'add', 'general/bench-new')),
+        ('tags remove', ('tags', 'remove', tag)),
+        ('tags rename', ('tags', 'rename', tag, 'general/bench-renamed')),
+        ('repos add', ('repos', 'add', 'bench/new', new_repo)),
+        ('repos remove', ('repos', 'remove', repo)),
+        ('repos rename', ('repos', 'rename', repo, 'bench/renamed')),
+        ('repos tag', ('repos', 'tag', repo, untagged)),
+        ('repos untag', ('repos', 'untag', repo, linked[0])),
+        ('repos tag-many', ('repos', 'tag-many', untagged, 'find:' + word)),
+        ('repos untag-many', ('repos', 'untag-many', tag, 'links:' + tag)),
+    ]
+
+    def startup():
+        return _tag.get_targets(data_dir)
+
+    def run(cmd):
+        targets = startup()
+        with Silenced():
+            start = time.time()
+            _tag.process_cmd(targets, *cmd)
+            elapsed = time.time() - start
+            _tag.flush_targets(targets)
+        return elapsed
+
+    def autotag():
+        targets = startup()
+        tagger = AutoTagger(targets['tags'], targets['repos'],
+                            SuggestActions())
+        tagger.tag_language = tagger.tag_original = True
+        keys = list(targets['repos'].keys())
+        with Silenced():
+            start = time.time()
+            tagger.autotag(default_definitions(), keys)
+            return time.time() - start
+
+    def run_write(cmd):
+        # On a throwaway copy of the data dir and its caches, so every run
+        # starts from the same one. The flush is timed too, it's where the
+        # indexes are written.
+        work = tempfile.mkdtemp(prefix='tagg-bench-')
+        try:
+            copy = path.join(work, path.basename(data_dir))
+            shutil.copytree(data_dir, copy, symlinks=True)
+            targets = _tag.get_targets(copy)
+            with Silenced():
+                start = time.time()
+                _tag.process_cmd(targets, *cmd)
+                _tag.flush_targets(targets)
+                return time.time() - start
+        finally:
+            shutil.rmtree(work, ignore_errors=True)
+
+    def prime():
+        targets = startup()
+        list(targets['repos'].find_links([]))
+        _tag.flush_targets(targets)
+
+    cache_dir = path.join(data_dir, '.tagg')
+    results = []
+
+    def add(op, seconds):
+        results.append({'bench': 'data_dir', 'op': op, 'seconds': seconds,
+                        'repos': info['repos'], 'tags': info['tags'],
+                        'links': info['links']})
+
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    add('startup cold', timeit(startup, 1))
+    add('index build', timeit(prime, 1))
+    add('startup', timeit(startup, repeat))
+    for name, cmd in cmds:
+        add(name, min(run(cmd) for i in xrange(repeat)))
+    for name, cmd in writes:
+        add(name, min(run_write(cmd) for i in xrange(repeat)))
+    add('autotag -a', min(autotag() for i in xrange(repeat)))
+    return results
+
+
+def bench_links(repos, tags, links, seed=0):
+    # Resolves every link of a generated data dir, with readlink and with
+    # realpath
+    data_dir = tempfile.mkdtemp(prefix='tagg-bench-')
+    try:
+        generate(data_dir, repos, tags, links, seed)
+        store = _tag.get_targets(data_dir)['repos']
+        lpaths = []
+        for key in store.keys():
+            p = store.get_path(key)
+            lpaths.extend(path.join(p, i) for i in os.listdir(p)
+                          if path.islink(path.join(p, i)))
+
+        def resolve(func):
+            return lambda: [func(i) for i in lpaths]
+
+        assert [i.key for i in resolve(store.get_linked)()] == \
+            [i.key for i in resolve(store.get_linked_realpath)()]
+
+        ret = {
+            'bench': 'links',
+            'repos': repos,
+            'tags': tags,
+            'links': len(lpaths),
+            'readlink': timeit(resolve(store.get_linked)),
+            'realpath': timeit(resolve(store.get_linked_realpath)),
+        }
+        ret['speedup'] = ret['realpath'] / max(ret['readlink'], 1e-9)
+        return ret
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def bench_sizes(sizes, tags_ratio, links, repeat, seed=0, keep=None):
+    # keep is an empty dir to keep the data dirs in, one per size
+    for i, size in enumerate(sizes):
+        if keep:
+            data_dir = path.join(keep, '%d-%d' % (i, size))
+        else:
+            data_dir = tempfile.mkdtemp(prefix='tagg-bench-')
+        try:
+            start = time.time()
+            info = generate(data_dir, size, max(20, int(size * tags_ratio)),
+                            links, seed)
+            yield {'bench': 'data_dir', 'op': 'generate',
+                   'seconds': time.time() - start, 'repos': info['repos'],
+                   'tags': info['tags'], 'links': info['links']}
+            for r in bench_data_dir(data_dir, info, repeat):
+                yield r
+        finally:
+            if not keep:
+                shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def check_empty(d):
+    # Nothing is ever removed from the dirs given by the user
+    if path.exists(d) and os.listdir(d):
+        print >> sys.stderr, '%s is not empty' % d
+        sys.exit(1)
+
+
+def int_list(s):
+    return [int(i) for i in s.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks of tagg. Results are printed as json lines')
+    subs = parser.add_subparsers()
+
+    pp = subs.add_parser('patterns',
+                         help='Fused definition patterns vs one by one')
+    pp.add_argument('--rules', type=int_list, default=[10, 100, 1000],
+                    help='Numbers of pattern rules, separated by ,')
+    pp.add_argument('--names', type=int, default=2000,
+                    help='Number of repo names to match')
+    pp.add_argument('--seed', type=int, default=0)
+    pp.set_defaults(cmd='patterns')
+
+    lp = subs.add_parser('links',
+                         help='Resolving links with readlink vs realpath')
+    lp.add_argument('--sizes', type=int_list, default=[1000, 10000],
+                    help='Numbers of repos, separated by ,')
+    lp.add_argument('--tags', type=int, default=500)
+    lp.add_argument('--links', type=int, default=5,
+                    help='Average number of links per repo')
+    lp.add_argument('--seed', type=int, default=0)
+    lp.set_defaults(cmd='links')
+
+    gp = subs.add_parser('generate', help='Generate a synthetic data dir')
+    gp.add_argument('data_dir')
+    gp.add_argument('--repos', type=int, default=1000)
+    gp.add_argument('--tags', type=int, default=200)
+    gp.add_argument('--links', type=int, default=3,
+                    help='Average number of links per repo')
+    gp.add_argument('--seed', type=int, default=0)
+    gp.set_defaults(cmd='generate')
+
+    dp = subs.add_parser('data', help='Time the cmds, store startup and '
+                         'autotag on generated data dirs of several sizes')
+    dp.add_argument('--sizes', type=int_list, default=[1000, 10000],
+                    help='Numbers of repos, separated by ,')
+    dp.add_argument('--tags-ratio', type=float, default=0.05,
+                    help='Number of tags per repo generated')
+    dp.add_argument('--links', type=int, default=3,
+                    help='Average number of links per repo')
+    dp.add_argument('--repeat', type=int, default=1)
+    dp.add_argument('--seed', type=int, default=0)
+    dp.add_argument('--keep',
+                    help='Generate the data dirs in this empty dir and keep '
+                    'them, instead of temporary ones')
+    dp.set_defaults(cmd='data')
+
+    args = parser.parse_args()
+    commit = git_commit()
+    if args.cmd == 'patterns':
+        results = (bench_patterns(rules, args.names, args.seed)
+                   for rules in args.rules)
+    elif args.cmd == 'links':
+        results = (bench_links(size, args.tags, args.links, args.seed)
+                   for size in args.sizes)
+    elif args.cmd == 'generate':
+        check_empty(args.data_dir)
+        generate(args.data_dir, args.repos, args.tags, args.links, args.seed)
+        return
+    elif args.cmd == 'data':
+        if args.keep:
+            check_empty(args.keep)
+        results = bench_sizes(args.sizes, args.tags_ratio, args.links,
+                              args.repeat, args.seed, args.keep)
+
+    for r in results:
+        r['commit'] = commit
+        print json.dumps(r, sort_keys=True)
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -5,8 +5,13 @@ import sys
 import re
 import os.path as path
 import argparse
+import time
+import datetime
 
 from tagg import *
+from tagg.instrument import Profiler, profiling
+from tagg.index import KeyTrie
+from tagg.query import is_query
 
 
 def list_print(l):
@@ -111,7 +116,8 @@ try:
             (\s* 
             repos \s (?P<repocmd>tag|untag) \s (?P<repokey>[\w/\-\._]*) \s (?P<tagkey>[\w/\-\._]*)(,(?P<tagkey>[\w/\-\._]*))* | 
             repos \s (?P<repocmd>links) \s (?P<tagkey>[\w/\-\._]*)(,(?P<tagkey>[\w/\-\._]*))* |
-            repos \s (?P<repocmd>add|show|remove|edit|rename) \s (?P<repokey>[\w/\-\._]*) |
+            repos \s (?P<repocmd>tag-many|untag-many) \s (?P<tagkey>[\w/\-\._]*) \s (links|find):(?P<tagkey>[\w/\-\._]*)(,(?P<tagkey>[\w/\-\._]*))* |
+            repos \s (?P<repocmd>add|show|remove|edit|rename|refresh) \s (?P<repokey>[\w/\-\._]*) |
             tags \s (?P<tagcmd>add|show|remove|edit|rename) \s (?P<tagkey>[\w/\-\._]*) 
             )
         """)
@@ -145,32 +151,6 @@ try:
             for i in self.func(w):
                 yield Completion(i, -len(w))
 
-    class CachedHints(object):
-        def __init__(self, store):
-            self.store = store
-            self.store.add_listener(self.on_change)
-            self.cache = {}
-
-        def on_change(self, ev, **kwargs):
-            if ev in ('add_key', 'remove_key', 'rename_key'):
-                self.cache = {}
-
-        def __call__(self, prefix):
-            if len(prefix) < 1:
-                return []
-            o = path.dirname(prefix)
-            name = path.basename(prefix)
-            dirs = self.cache.get(o, [])
-            if not dirs:
-                dirs = self.cache[o] = self.store.key_hints(o)
-
-            ret = []
-            for i in dirs:
-                if i.startswith(name):
-                    ret.append(path.join(o, i))
-
-            return ret
-
     class TagCli(object):
         def __init__(self, targets, parser):
             self.targets = targets
@@ -187,14 +167,14 @@ try:
                                      "tagcmd": Token.Operator
                                  })
             hinters = {
-                'repos': CachedHints(self.targets['repos']),
-                'tags': CachedHints(self.targets['tags'])
+                'repos': KeyTrie(self.targets['repos']),
+                'tags': KeyTrie(self.targets['tags'], unique=True)
             }
             completer = GrammarCompleter(g, {
                 'repocmd': WordCompleter(repo_cmds),
                 'tagcmd': WordCompleter(cmds),
-                'repokey': CustomCompleter(hinters['repos']),
-                'tagkey': CustomCompleter(hinters['tags']),
+                'repokey': CustomCompleter(hinters['repos'].complete),
+                'tagkey': CustomCompleter(hinters['tags'].complete),
             })
             while True:
                 try:
@@ -218,12 +198,135 @@ except ImportError, e:
     TagCli = None
 
 
+# Export
+def export_items(store, keys, with_links=False, since=None):
+    for key in keys:
+        m = store.get(key)
+        updated_at = m.get('updated_at', None)
+        if since and updated_at and updated_at <= since:
+            continue
+        data = m.meta
+        if with_links:
+            data = data.copy()
+            data['tags'] = [i.key for i in m.links]
+        yield key, data
+
+
+def write_json_section(out, name, items):
+    # Writes the items as json_dumps would format a dict of them nested in
+    # the top level one, but one item at a time
+    out.write('\n  %s: {' % json.dumps(name))
+    sep = ''
+    for key, data in items:
+        out.write('%s\n    %s: %s' % (sep, json.dumps(key),
+                                      json_dumps(data).replace('\n', '\n    ')))
+        sep = ', '
+    out.write(sep and '\n  }' or '}')
+
+
+def export_json(targets, out, since=None):
+    repostore = targets['repos']
+    tagstore = targets['tags']
+    out.write('{')
+    if since:
+        removed = {'repos': repostore.removed_since(since),
+                   'tags': tagstore.removed_since(since)}
+        out.write('\n  "removed": %s, ' %
+                  json_dumps(removed).replace('\n', '\n  '))
+    write_json_section(out, 'repos', export_items(
+        repostore, sorted(repostore.keys()), True, since))
+    out.write(', ')
+    write_json_section(out, 'tags', export_items(
+        tagstore, sorted(tagstore.keys()), False, since))
+    out.write('\n}\n')
+
+
+def export_jsonl(targets, out, since=None):
+    # One record per line in walk order, so consumers can start right away
+    repostore = targets['repos']
+    tagstore = targets['tags']
+    items = [('repo', repostore, True), ('tag', tagstore, False)]
+    for type_, store, with_links in items:
+        if since:
+            for key in store.removed_since(since):
+                out.write(json.dumps({'type': type_, 'key': key,
+                                      'deleted': True},
+                                     sort_keys=True) + '\n')
+        for key, data in export_items(store, store.keys(), with_links, since):
+            out.write(json.dumps({'type': type_, 'key': key, 'data': data},
+                                 sort_keys=True) + '\n')
+
+
+export_formats = {'json': export_json, 'jsonl': export_jsonl}
+
+
+# The timestamps export --since takes, down to the ones written by timestamp()
+SINCE_FORMATS = ('%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S',
+                 '%Y-%m-%dT%H:%M:%S.%f')
+
+
+def read_since(since):
+    # Either a timestamp or a checkpoint file written by a previous export
+    if path.isfile(since):
+        with open(since, 'r') as f:
+            return json.load(f)['since']
+
+    since = since.replace(' ', 'T')
+    for fmt in SINCE_FORMATS:
+        try:
+            datetime.datetime.strptime(since, fmt)
+            return since
+        except ValueError:
+            pass
+    raise Error('%s is neither a checkpoint file nor an ISO timestamp' %
+                since)
+
+
+def query_keys(targets, query):
+    # Repo keys from a links:tag1,tag2 or find:keyword1,keyword2 query. The
+    # links one may be a boolean query too, see tagg.query
+    kind, sep, value = query.partition(':')
+    items = [i.strip() for i in value.split(',') if i.strip()]
+    if not sep or kind not in ('links', 'find') or not items:
+        raise Error('Unknown query %s. Use links:tag1,tag2 or '
+                    'find:keyword1,keyword2' % query)
+
+    repostore = targets['repos']
+    if kind == 'find':
+        return repostore.find_keywords(items)
+    if is_query(value):
+        return repostore.query(value, targets['tags'])
+
+    tags = []
+    for i in items:
+        tag = targets['tags'].get(i)
+        if not tag or not tag.exists:
+            raise Error("Tag %s doesn't exist" % i)
+        tags.append(tag)
+    # Listed before any link changes, so they don't affect the query
+    return list(repostore.find_links(tags))
+
+
+def read_keys(f):
+    for line in read_lines(f):
+        yield line.strip()
+
+
+def write_checkpoint(fn, since):
+    with open(fn, 'w') as f:
+        json_dump({'since': since}, f)
+
+
 # Cli Core
 def process_cmd(targets, cmd,
                 subcmd=None,
                 key=None,
                 value=None,
-                confirm_session=None):
+                confirm_session=None,
+                fmt='json',
+                since=None,
+                checkpoint=None,
+                stdin=None):
     target = None
     cs = confirm_session or ConfirmSession()
     target = targets.get(cmd, None)
@@ -239,14 +342,16 @@ def process_cmd(targets, cmd,
     elif subcmd == 'links':
         if not key:
             raise Error('a key or multiple keys separated by , is required')
-
-        tags = []
-        for i in key.split(','):
-            tag = tagstore.get(i)
-            if not tag or not tag.exists:
-                raise Error("Tag %s doesn\'t exist")
-            tags.append(tag)
-        list_print(repostore.find_links(tags))
+        if is_query(key):
+            list_print(repostore.query(key, tagstore))
+        else:
+            tags = []
+            for i in key.split(','):
+                tag = tagstore.get(i)
+                if not tag or not tag.exists:
+                    raise Error("Tag %s doesn\'t exist")
+                tags.append(tag)
+            list_print(repostore.find_links(tags))
     elif subcmd == 'add':
         if not key:
             raise Error('a key is required')
@@ -298,6 +403,50 @@ def process_cmd(targets, cmd,
                 print 'Added link', tag, 'to', key
             else:
                 print 'Can\'t add link', tag, 'to', key, 'Proabably already existed'
+    elif subcmd in ('tag-many', 'untag-many') and target is repostore:
+        if not key:
+            raise Error('a tag is required')
+        if value:
+            keys = query_keys(targets, value)
+        elif stdin and not stdin.isatty():
+            keys = read_keys(stdin)
+        else:
+            raise Error('a links:tag1,tag2 or find:keyword1,keyword2 query '
+                        'is required, or repo keys piped in')
+
+        tag = tagstore.get(key)
+        if subcmd == 'tag-many' and (not tag or not tag.exists):
+            if not cs.confirm('Tag %s doesn\'t exist. Create' % key):
+                raise Error('Tag doesn\'t exist: %s. Abort' % key)
+            tag = tagstore.add_key(key)
+        if not tag:
+            raise Error('Tag %s doesn\'t exist' % key)
+
+        # Every repo gets its meta written once, however many cmds ran
+        changed = 0
+        with repostore.batch():
+            for k in keys:
+                if subcmd == 'tag-many':
+                    r = repostore.add_link(k, tag)
+                    print '%s link %s to %s' % (
+                        r and 'Added' or 'Skipped', tag, k)
+                else:
+                    # remove_link() is True for links which aren't there
+                    lpath = path.join(repostore.get_path(k.lower()), tag.name)
+                    r = path.islink(lpath) and \
+                        repostore.remove_link(k, tag.name)
+                    print '%s link %s from %s' % (
+                        r and 'Removed' or 'Skipped', tag.name, k)
+                changed += bool(r)
+        print '%d repos changed' % changed
+    elif subcmd == 'refresh' and target is repostore:
+        keys = None
+        if key:
+            keys = [i.strip() for i in key.split(',')]
+        changed = repostore.refresh(keys)
+        for k, fields in changed:
+            print 'Refreshed %s: %s' % (k, ', '.join(fields))
+        print '%d repos changed' % len(changed)
     elif subcmd == 'untag' and target is repostore:
         if not value:
             raise Error('a tag is required')
@@ -312,6 +461,7 @@ def process_cmd(targets, cmd,
         p = target.get(key)
         fn = path.join(p.get_path(), target.meta_name)
         os.system('vim %s' % fn)
+        target.changed(key)
     elif subcmd == 'validate':
         print target.validate()
         print 'Done'
@@ -319,37 +469,174 @@ def process_cmd(targets, cmd,
         stats = target.link_stats()
         print ', '.join(['%s(%d)' % (i[0], i[1]) for i in stats])
     elif cmd == 'export':
-        repos = {}
-        for key in repostore.keys():
-            repo = repostore.get(key)
-            m = repo.meta.copy()
-            m['tags'] = [i.key for i in repo.links]
-            repos[key] = m
-
-        tags = {}
-        for key in tagstore.keys():
-            tags[key] = tagstore.get(key).meta
-
-        data = {'repos': repos, 'tags': tags}
-        print json_dumps(data)
+        if fmt not in export_formats:
+            raise Error('Unknown export format %s' % fmt)
+        started = timestamp()
+        if since:
+            if not checkpoint and path.isfile(since):
+                checkpoint = since
+            since = read_since(since)
+        export_formats[fmt](targets, sys.stdout, since)
+        if checkpoint:
+            write_checkpoint(checkpoint, started)
     else:
         raise Error('Unknown cmd %s' % cmd)
 
 
 cmds = ['list', 'add', 'remove', 'rename', 'show', 'edit', 'validate', 'links',
         'find', 'link_stats']
-repo_cmds = cmds + ['tag', 'untag']
+repo_cmds = cmds + ['tag', 'untag', 'refresh', 'tag-many', 'untag-many']
 
 
 def get_targets(data_dir='.'):
-    tagstore = UniqueCachedMetaStore('Tags', path.join(data_dir, 'tags'))
+    cache_dir = path.join(data_dir, '.tagg')
+    tagstore = UniqueCachedMetaStore('Tags', path.join(data_dir, 'tags'),
+                                     cache_dir=cache_dir)
     repostore = GithubMetaStore('Github Repos', path.join(data_dir, 'repos'),
-                                linked_stores=[tagstore])
+                                linked_stores=[tagstore],
+                                cache_dir=cache_dir)
     targets = {'tags': tagstore, 'repos': repostore, }
     return targets
 
 
-def main():
+def run_args(targets, args, confirm_session=None, stdin=None):
+    return process_cmd(targets, args.cmd, args.subcmd, args.key, args.value,
+                       confirm_session,
+                       fmt=getattr(args, 'format', 'json'),
+                       since=getattr(args, 'since', None),
+                       checkpoint=getattr(args, 'checkpoint', None),
+                       stdin=stdin)
+
+
+def is_piped(parser, argv):
+    # Whether the cmds, or the values of the % in argv, are piped in. Others
+    # read their repo keys from stdin or don't read it at all.
+    if not argv or '%' in argv:
+        return True
+    try:
+        args = parser.parse_args(argv)
+    except SystemExit:
+        return True
+    if args.cmd == 'serve':
+        return False
+    return not (args.cmd == 'repos' and
+                args.subcmd in ('tag-many', 'untag-many') and not args.value)
+
+
+def cmd_name(args):
+    return ' '.join(i for i in (args.cmd, args.subcmd) if i)
+
+
+def flush_targets(targets):
+    for store in targets.values():
+        store.flush()
+
+
+def rescan_targets(targets):
+    # The tags first, the links of the repos are found among them
+    targets['tags'].rescan()
+    targets['repos'].rescan()
+
+
+class BatchRunner(object):
+    # Runs many cmds with the stores of each data dir built only once, so
+    # their caches stay warm from one cmd to the next
+    def __init__(self, parser, report_every=1000, profiler=None,
+                 targets=None):
+        self.parser = parser
+        self.profiler = profiler or Profiler()
+        self.report_every = report_every
+        self.targets = {}
+        if targets:
+            # Stores loaded already, by the absolute path of their data dir
+            for data_dir, t in targets.iteritems():
+                self.targets[data_dir] = t
+                for store in t.values():
+                    store.begin_batch()
+        self.count = 0
+        self.started = time.time()
+        self.pending_adds = []  # (targets, key) of repos to add in bulk
+        self.max_pending_adds = 500
+
+    def get_targets(self, data_dir):
+        data_dir = path.abspath(data_dir)
+        targets = self.targets.get(data_dir, None)
+        if targets is None:
+            targets = self.targets[data_dir] = get_targets(data_dir)
+            for store in targets.values():
+                store.begin_batch()
+        return targets
+
+    def run(self, argv):
+        args = self.parser.parse_args(argv)
+        with self.profiler.cmd('startup'):
+            targets = self.get_targets(args.data_dir)
+        with self.profiler.cmd(cmd_name(args)):
+            self.run_args(targets, args)
+        self.count += 1
+        if self.report_every and self.count % self.report_every == 0:
+            with self.profiler.cmd('commit'):
+                self.commit()
+            self.report()
+
+    def run_args(self, targets, args):
+        if args.cmd == 'repos' and args.subcmd == 'add' and args.key and \
+                not args.value:
+            # Their meta is fetched from Github, which is done in bulk
+            if self.pending_adds and self.pending_adds[0][0] is not targets:
+                self.add_pending()
+            self.pending_adds.append((targets, args.key))
+            if len(self.pending_adds) >= self.max_pending_adds:
+                self.add_pending()
+        else:
+            self.add_pending()
+            run_args(targets, args, NoConfirmSession())
+
+    def add_pending(self):
+        if not self.pending_adds:
+            return
+        targets = self.pending_adds[0][0]
+        keys = [i[1] for i in self.pending_adds]
+        self.pending_adds = []
+        added = set(m.key for m in targets['repos'].add_keys(keys))
+        for key in keys:
+            if key.lower() in added:
+                added.discard(key.lower())
+                print 'Added', key
+            else:
+                print 'Add failed. Probably already existed.'
+
+    def commit(self):
+        self.add_pending()
+        for targets in self.targets.values():
+            for store in targets.values():
+                store.commit_batch()
+                store.begin_batch()
+
+    def report(self):
+        elapsed = time.time() - self.started
+        print >> sys.stderr, 'Processed %d cmds in %.2fs (%.1f cmds/s)' % (
+            self.count, elapsed, self.count / max(elapsed, 1e-6))
+
+    def finish(self):
+        self.add_pending()
+        for targets in self.targets.values():
+            for store in targets.values():
+                store.commit_batch()
+            flush_targets(targets)
+        self.report()
+
+
+def read_lines(f):
+    # Unlike iterating the file, this doesn't wait for a full read-ahead
+    # buffer so cmds are run as soon as they are piped in
+    for line in iter(f.readline, ''):
+        if line.startswith('#') or not line.strip():
+            continue
+        yield line
+
+
+def make_parser():
     parser = argparse.ArgumentParser(
         description='Shortcut functions to manipulate tags and repos')
     parser.add_argument('-d', '--data-dir',
@@ -359,6 +646,7 @@ def main():
                         action='store_true',
                         help='Force operate in an empty data dir',
                         default=False)
+    add_profile_args(parser)
     subs = parser.add_subparsers()
 
     rp = subs.add_parser('repos')
@@ -375,6 +663,16 @@ def main():
 
     ep = subs.add_parser('export')
     ep.set_defaults(cmd='export')
+    ep.add_argument('--format',
+                    choices=sorted(export_formats),
+                    default='json',
+                    help='json: one document, jsonl: one repo or tag per line')
+    ep.add_argument('--since',
+                    help='Only export what changed after an ISO timestamp or '
+                    'the one in a checkpoint file, removed keys included')
+    ep.add_argument('--checkpoint',
+                    help='Write a checkpoint file for the next --since. '
+                    'Defaults to the --since file if any')
     ep.add_argument('subcmd', nargs='?')
     ep.add_argument('key', nargs='?')
     ep.add_argument('value', nargs='?')
@@ -384,55 +682,94 @@ def main():
     ep.add_argument('subcmd', nargs='?')
     ep.add_argument('key', nargs='?')
     ep.add_argument('value', nargs='?')
-    stdin = ''
-    if not sys.stdin.isatty():
-        stdin = sys.stdin.readlines()
-        if len(sys.argv) > 1:
+
+    sp = subs.add_parser('serve',
+                         help='Keep the stores of the data dir loaded and run '
+                         'the cmds of tagg sent to .tagg/tagg.sock')
+    sp.set_defaults(cmd='serve', subcmd=None, key=None, value=None)
+    return parser
+
+
+def main():
+    parser = make_parser()
+    opts, argv = split_profile_args(sys.argv[1:])
+    with profiling(opts.profile, opts.profile_dump) as profiler:
+        if not sys.stdin.isatty() and is_piped(parser, argv):
+            run_piped(parser, argv, sys.stdin, profiler)
+            sys.exit(0)
+
+        args = parser.parse_args(argv)
+        if args.cmd == 'serve':
+            from tagg.server import serve
+            serve(args.data_dir, parser)
+            sys.exit(0)
+
+        with profiler.cmd('startup'):
+            targets = get_targets(args.data_dir)
+        if not path.exists(targets['tags'].root) and not path.exists(
+            targets['repos'].root) and not args.force:
+            raise Error(
+                "%s doesn't seem to have any data in it. Use --force to operate in it."
+                % args.data_dir)
+
+        if args.cmd == 'shell':
+            # Enter REPL
+            if TagCli:
+                TagCli(targets, parser).run()
+                flush_targets(targets)
+            else:
+                print "You have to install prompt_toolkit & pygments to use REPL mode"
+            sys.exit(0)
+
+        # Run cmd n quit
+        run_cmd(targets, args, sys.stdin, profiler)
+
+
+def split_profile_args(argv):
+    # Known before the cmds, which may come from stdin
+    pre = argparse.ArgumentParser(add_help=False)
+    add_profile_args(pre)
+    return pre.parse_known_args(argv)
+
+
+def run_cmd(targets, args, stdin, profiler, confirm_session=None):
+    with profiler.cmd(cmd_name(args)):
+        run_args(targets, args, confirm_session, stdin=stdin)
+    with profiler.cmd('flush'):
+        flush_targets(targets)
+
+
+def add_profile_args(parser):
+    parser.add_argument('--profile',
+                        action='store_true',
+                        default=False,
+                        help='Print the filesystem ops, store calls and cache '
+                        'hits of each cmd to stderr when done')
+    parser.add_argument('--profile-dump',
+                        metavar='FILE',
+                        help='Write the same as json to FILE')
+
+
+def run_piped(parser, argv, stdin, profiler, targets=None):
+    runner = BatchRunner(parser, profiler=profiler, targets=targets)
+    try:
+        if argv:
             # Piped arguments
-            r = sys.argv[:]
-            if not '%' in r:
+            if not '%' in argv:
                 raise Error(
                     'You need to specify a %% mark to use partial arguments')
-            pos = r.index('%') - 1
-            for line in stdin:
-                if line.startswith('#'):
-                    continue
-                r = sys.argv[1:]
+            pos = argv.index('%')
+            for line in read_lines(stdin):
+                r = argv[:]
                 r[pos] = line.strip()
-                args = parser.parse_args(r)
-                targets = get_targets(args.data_dir)
-                process_cmd(targets, args.cmd, args.subcmd, args.key,
-                            args.value, NoConfirmSession())
+                runner.run(r)
         else:
             # Piped cmds
-            for line in stdin:
-                if line.startswith('#'):
-                    continue
-                args = parser.parse_args([i.strip()
-                                          for i in re.split(r'\s+', line, 3)])
-                targets = get_targets(args.data_dir)
-                process_cmd(targets, args.cmd, args.subcmd, args.key,
-                            args.value, NoConfirmSession())
-        sys.exit(0)
-
-    args = parser.parse_args()
-    targets = get_targets(args.data_dir)
-    if not path.exists(targets['tags'].root) and not path.exists(
-        targets['repos'].root) and not args.force:
-        raise Error(
-            "%s doesn't seem to have any data in it. Use --force to operate in it."
-            % args.data_dir)
-
-    if args.cmd == 'shell':
-        # Enter REPL
-        if TagCli:
-            TagCli(targets, parser).run()
-        else:
-            print "You have to install prompt_toolkit & pygments to use REPL mode"
-        sys.exit(0)
-
-    # Run cmd n quit
-    process_cmd(targets, args.cmd, args.subcmd, args.key, args.value)
+            for line in read_lines(stdin):
+                runner.run([i.strip() for i in re.split(r'\s+', line, 3)])
+    finally:
+        with profiler.cmd('flush'):
+            runner.finish()
 
 
 if __name__ == '__main__':
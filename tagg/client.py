@@ -0,0 +1,102 @@
+import os
+import sys
+import json
+import socket
+import os.path as path
+
+# Kept to the standard library, so forwarding a cmd to a running
+# 'tagg serve' doesn't pay for importing the rest of tagg
+
+
+# Cmds which need the terminal, or are the server itself
+local_cmds = ('serve', 'shell', 'edit')
+
+
+def socket_path(data_dir):
+    return path.join(data_dir, '.tagg', 'tagg.sock')
+
+
+def data_dir_of(argv):
+    for i, arg in enumerate(argv):
+        if arg in ('-d', '--data-dir') and i + 1 < len(argv):
+            return argv[i + 1]
+        if arg.startswith('--data-dir='):
+            return arg.split('=', 1)[1]
+    return './'
+
+
+def connect(fn):
+    # None if no server is listening on fn
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(fn)
+    except socket.error:
+        sock.close()
+        return None
+    return sock
+
+
+def request(sock, argv, tty=True, cwd=None, out=None, err=None):
+    # Runs argv as the arguments of tagg in the server. Its output is written
+    # to out and err as it comes, if given, or else returned in the dict of
+    # its exit 'code', as 'out' and 'err'. The dict is of 'local' instead if
+    # the cmd reads stdin, given it's not a tty, and has to be run by the
+    # client.
+    got = {'out': [], 'err': []}
+    files = {'out': out, 'err': err}
+    try:
+        sock.sendall(json.dumps({
+            'argv': argv,
+            'tty': tty,
+            'cwd': cwd or os.getcwd(),
+        }) + '\n')
+        for line in sock.makefile('r'):
+            r = json.loads(line)
+            if 'local' in r:
+                return r
+            for name, chunk in r.items():
+                if name not in files:
+                    continue
+                if files[name]:
+                    files[name].write(chunk.encode('utf-8'))
+                    files[name].flush()
+                else:
+                    got[name].append(chunk)
+            if 'code' in r:
+                break
+        else:
+            # It died mid-cmd
+            r = {'code': 1}
+            msg = 'The server closed the connection\n'
+            if err:
+                err.write(msg)
+            else:
+                got['err'].append(msg)
+    finally:
+        sock.close()
+    if not out:
+        r['out'] = u''.join(got['out'])
+    if not err:
+        r['err'] = u''.join(got['err'])
+    return r
+
+
+def main():
+    argv = sys.argv[1:]
+    fn = socket_path(data_dir_of(argv))
+    sock = None
+    if not set(argv) & set(local_cmds) and path.exists(fn):
+        sock = connect(fn)
+
+    r = sock and request(sock, argv, sys.stdin.isatty(),
+                         out=sys.stdout, err=sys.stderr)
+    if not r or r.get('local'):
+        # Piped cmds are run as they come in, which the server can't do
+        from .cli import main as cli_main
+        return cli_main()
+
+    sys.exit(r['code'])
+
+
+if __name__ == '__main__':
+    main()
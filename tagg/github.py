@@ -1,54 +1,359 @@
 import requests
 import sys
 import time
+import urllib
+import os
+import json
+import hashlib
+import threading
+from collections import Counter
 from os import path
-from urlparse import urljoin
+from urlparse import urljoin, urlsplit, urlunsplit, parse_qsl
+from multiprocessing.pool import ThreadPool
+
+
+def url_page(url):
+    for k, v in parse_qsl(urlsplit(url).query):
+        if k == 'page' and v.isdigit():
+            return int(v)
+    return None
+
+
+def set_url_page(url, page):
+    parts = urlsplit(url)
+    query = [(k, v) for k, v in parse_qsl(parts.query) if k != 'page']
+    query.append(('page', str(page)))
+    return urlunsplit(parts._replace(query=urllib.urlencode(query)))
+
+
+class ResponseCache(object):
+    # Responses kept on disk by url with their ETag, so they can be
+    # revalidated with a conditional request. The least recently used ones
+    # are evicted once the cache grows over max_bytes.
+    def __init__(self, root, max_bytes=64 * 1024 * 1024):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.size = None
+        self.lock = threading.Lock()
+
+    def _fn(self, key):
+        return path.join(self.root, hashlib.sha1(key).hexdigest() + '.json')
+
+    def get(self, key):
+        fn = self._fn(key)
+        try:
+            with open(fn, 'r') as f:
+                entry = json.load(f)
+            os.utime(fn, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return entry
+
+    def put(self, key, entry):
+        with self.lock:
+            if not path.isdir(self.root):
+                os.makedirs(self.root)
+            if self.size is None:
+                self.size = sum(i[2] for i in self._files())
+
+            fn = self._fn(key)
+            if path.isfile(fn):
+                self.size -= path.getsize(fn)
+            with open(fn, 'w') as f:
+                json.dump(entry, f)
+            self.size += path.getsize(fn)
+
+            if self.size > self.max_bytes:
+                self.evict(self.max_bytes * 3 / 4)
+
+    def _files(self):
+        for fn in os.listdir(self.root):
+            fp = path.join(self.root, fn)
+            try:
+                st = os.stat(fp)
+            except OSError:
+                continue
+            yield st.st_mtime, fp, st.st_size
+
+    def evict(self, target):
+        for mtime, fp, size in sorted(self._files()):
+            if self.size <= target:
+                break
+            os.unlink(fp)
+            self.size -= size
+
+
+class RateBucket(object):
+    # Token bucket of one quota. Up to burst_ratio of the limit can be spent
+    # right away, then tokens come back at the pace that spreads the
+    # remaining quota evenly until the reset time sent by Github.
+    def __init__(self, burst_ratio):
+        self.burst_ratio = burst_ratio
+        self.limit = None
+        self.remaining = None
+        self.reset = None
+        self.tokens = None  # Unknown until the first response
+        self.rate = 0
+        self.updated = time.time()
+
+    def capacity(self):
+        return max(1, int(self.limit * self.burst_ratio))
+
+    def refill(self, now):
+        if self.reset and now >= self.reset:
+            # New window, the next response tells what we have
+            self.tokens = None
+            self.reset = None
+        elif self.tokens is not None:
+            self.tokens = min(self.capacity(),
+                              self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, now):
+        # Until a token is back
+        if self.rate > 0:
+            return (1 - self.tokens) / self.rate
+        return max(self.reset - now, 1)
+
+    def update(self, limit, remaining, reset, now):
+        self.refill(now)
+        self.limit = limit
+        self.remaining = remaining
+        self.reset = reset
+        if self.tokens is None:
+            self.tokens = self.capacity()
+        self.tokens = min(self.tokens, remaining)
+        self.rate = float(remaining) / max(reset - now, 1)
+
+    def metrics(self):
+        return {
+            'limit': self.limit,
+            'remaining': self.remaining,
+            'reset': self.reset,
+            'rate': self.rate,
+        }
+
+
+class RateLimiter(object):
+    # A RateBucket per resource of the API, core, search and so on, as each
+    # has a quota of its own, shared by all requests
+    def __init__(self, burst_ratio=0.5, max_retries=5, backoff=5):
+        self.burst_ratio = burst_ratio
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.counter = Counter()
+
+    def bucket(self, resource):
+        b = self.buckets.get(resource, None)
+        if b is None:
+            b = self.buckets[resource] = RateBucket(self.burst_ratio)
+        return b
+
+    def acquire(self, resource='core'):
+        while True:
+            with self.lock:
+                b = self.bucket(resource)
+                now = time.time()
+                b.refill(now)
+                if b.tokens is None or b.tokens >= 1:
+                    if b.tokens is not None:
+                        b.tokens -= 1
+                    self.counter['requests'] += 1
+                    return
+
+                wait = b.wait(now)
+            self.sleep(wait)
+
+    def refund(self, resource='core'):
+        # Gives the token of a request Github didn't count back, a 304 to a
+        # conditional one
+        with self.lock:
+            b = self.bucket(resource)
+            if b.tokens is not None:
+                b.tokens = min(b.tokens + 1, b.capacity(), b.remaining)
+            self.counter['not_modified'] += 1
+
+    def sleep(self, seconds):
+        with self.lock:
+            self.counter['waits'] += 1
+            self.counter['waited'] += seconds
+        time.sleep(seconds)
+
+    def update(self, headers, resource='core'):
+        # Returns the resource the response counted against, as told by
+        # Github if it did
+        resource = headers.get('X-RateLimit-Resource', resource)
+        try:
+            limit = int(headers['X-RateLimit-Limit'])
+            remaining = int(headers['X-RateLimit-Remaining'])
+            reset = int(headers['X-RateLimit-Reset'])
+        except (KeyError, ValueError):
+            return resource
+
+        with self.lock:
+            self.bucket(resource).update(limit, remaining, reset, time.time())
+        return resource
+
+    def retry_delay(self, r, attempt):
+        # How long to wait before retrying a rate limited response, None if
+        # it wasn't one or we gave up on it
+        if r.status_code not in (403, 429) or attempt >= self.max_retries:
+            return None
+
+        retry_after = r.headers.get('Retry-After', None)
+        if retry_after and retry_after.isdigit():
+            delay = int(retry_after)
+        elif r.headers.get('X-RateLimit-Remaining', None) == '0':
+            delay = max(int(r.headers.get('X-RateLimit-Reset', 0)) -
+                        time.time(), 1)
+        elif r.status_code == 429 or 'rate limit' in r.text.lower():
+            delay = self.backoff * 2 ** attempt
+        else:
+            return None
+
+        with self.lock:
+            self.counter['retries'] += 1
+        return delay
+
+    def metrics(self):
+        with self.lock:
+            ret = dict(self.counter)
+            ret['resources'] = dict((k, v.metrics())
+                                    for k, v in self.buckets.iteritems())
+        return ret
+
+
+limiter = RateLimiter()
 
 
 class GithubHelper(object):
-    def __init__(self, username=''):
+    def __init__(self, username='', api_root='https://api.github.com',
+                 workers=4, cache_dir=None, rate_limiter=None):
         self.token = ''
         self.username = username
-        self.api_root = 'https://api.github.com'
+        self.api_root = api_root
         self.ua = 'Tag-Github'
         self.headers = {'User-Agent': self.ua}
+        self.workers = workers
 
         if path.isfile('./.github_token'):
             with open('./.github_token', 'r') as f:
                 self.token = f.read().strip()
                 self.headers['Authorization'] = 'token ' + self.token
 
-    def _get(self, _path, params=None):
-        def _do(url):
-            from . import Error
-            r = requests.get(url, params=params, headers=self.headers)
-            limit = r.headers.get('X-RateLimit-Limit', -1)
-            remaining = r.headers.get('X-RateLimit-Remaining', -1)
-            if limit is not None:
-                print >> sys.stderr, 'Limit: %s/%s' % (remaining, limit)
-            if r.status_code != 200:
-                raise Error('Github returned error: %s' % r)
+        # One pooled session for all requests, so connections are reused
+        # instead of a TLS handshake per page
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=max(workers, 1))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.cache = None
+        if cache_dir:
+            self.cache = ResponseCache(cache_dir)
+        self.limiter = rate_limiter or limiter
 
+    def _map(self, func, items):
+        # Like imap, but with a bounded pool of threads. Results are yielded
+        # in the order of items.
+        items = list(items)
+        if self.workers <= 1 or len(items) <= 1:
+            for i in items:
+                yield func(i)
+            return
+
+        pool = ThreadPool(min(self.workers, len(items)))
+        try:
+            for r in pool.imap(func, items):
+                yield r
+        finally:
+            pool.terminate()
+
+    def resource_of(self, url):
+        # The quota a request to url counts against, until its response
+        # tells
+        p = urlsplit(url).path
+        root = urlsplit(self.api_root).path.rstrip('/')
+        if p.startswith(root + '/'):
+            p = p[len(root):]
+        if p.startswith('/search/code'):
+            return 'code_search'
+        if p.startswith('/search/'):
+            return 'search'
+        return 'core'
+
+    def _do(self, url, params=None):
+        from . import Error
+        url = requests.Request('GET', url, params=params).prepare().url
+        cache_key = '%s %s' % (self.token, url)
+        entry = self.cache and self.cache.get(cache_key)
+        headers = {}
+        if entry:
+            headers['If-None-Match'] = entry['etag']
+
+        resource = self.resource_of(url)
+        for attempt in xrange(self.limiter.max_retries + 1):
+            self.limiter.acquire(resource)
+            r = self.session.get(url, headers=headers)
+            resource = self.limiter.update(r.headers, resource)
+            delay = self.limiter.retry_delay(r, attempt)
+            if delay is None:
+                break
+            print >> sys.stderr, 'Rate limited, retrying in %ds' % delay
+            self.limiter.sleep(delay)
+
+        limit = r.headers.get('X-RateLimit-Limit', -1)
+        remaining = r.headers.get('X-RateLimit-Remaining', -1)
+        if limit is not None:
+            print >> sys.stderr, 'Limit: %s/%s' % (remaining, limit)
+
+        if r.status_code == 304 and entry:
+            # Unchanged, and not counted against the rate limit
+            self.limiter.refund(resource)
+            data = entry['data']
+            links = entry['links']
+        elif r.status_code != 200:
+            raise Error('Github returned error: %s' % r)
+        else:
             data = r.json()
             if isinstance(data, dict) and 'items' in data:
                 data = data['items']
+            links = r.links or {}
+            etag = r.headers.get('ETag', None)
+            if self.cache and etag:
+                self.cache.put(cache_key, {'etag': etag, 'data': data,
+                                           'links': links})
 
-            next_ = r.links and r.links.get('next', None) or None
-            if remaining == '0' and next_:
-                print >> sys.stderr, 'Sleeping for more quota'
-                time.sleep(60)
-            if not isinstance(data, list):
-                data = [data]
-            return data, next_
+        if not isinstance(data, list):
+            data = [data]
+        return data, links
 
-        items, next_url = _do(urljoin(self.api_root, _path))
+    def _get(self, _path, params=None):
+        items, links = self._do(urljoin(self.api_root, _path), params)
         for i in items:
             yield i
 
-        while next_url:
-            items, next_url = _do(next_url['url'])
+        next_ = links.get('next', None)
+        last = links.get('last', None)
+        if next_ and last and url_page(next_['url']) and url_page(last['url']):
+            # Paged by number: all the urls are known, fetch them together
+            urls = [set_url_page(next_['url'], i)
+                    for i in xrange(url_page(next_['url']),
+                                    url_page(last['url']) + 1)]
+            for items, links in self._map(self._do, urls):
+                for i in items:
+                    yield i
+            return
+
+        while next_:
+            items, links = self._do(next_['url'])
             for i in items:
                 yield i
+            next_ = links.get('next', None)
 
     def get_mine(self):
         return self._get('/users/%s/repos' % self.username)
@@ -59,6 +364,20 @@ class GithubHelper(object):
     def get_repo(self, full_name):
         return next(self._get('/repos/%s' % full_name))
 
+    def get_repos(self, full_names):
+        # Fetched concurrently, yielded in order. None for the ones failed,
+        # connection errors and timeouts included.
+        from . import Error
+
+        def _fetch(full_name):
+            try:
+                return self.get_repo(full_name)
+            except (Error, requests.RequestException), e:
+                print >> sys.stderr, 'Unable to fetch %s: %s' % (full_name, e)
+                return None
+
+        return self._map(_fetch, full_names)
+
     def get_top1k(self):
         return self._get('/search/repositories',
                          params={
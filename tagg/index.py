@@ -0,0 +1,744 @@
+import os
+import re
+import json
+import time
+import fcntl
+import urllib
+from bisect import bisect_left
+from contextlib import contextmanager
+import os.path as path
+
+
+def atomic_json_dump(data, fn):
+    d = path.dirname(fn)
+    if d and not path.isdir(d):
+        os.makedirs(d)
+
+    tmp = '%s.%d.tmp' % (fn, os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.rename(tmp, fn)
+
+
+def scan_dirs(root, meta_name, old, fresh_before):
+    # Walks the dirs of a store. A dir whose mtime is the one of its record
+    # in old, rel -> [mtime, children, sig, ...], and older than fresh_before
+    # keeps the children recorded, the others are listed again. Yields (rel,
+    # p, mtime, children, has_meta, rec), rec being the record of a dir kept
+    # and None for one listed.
+    stack = ['']
+    while stack:
+        rel = stack.pop()
+        p = path.join(root, rel)
+        try:
+            mtime = os.stat(p).st_mtime
+        except OSError:
+            continue
+
+        rec = old.get(rel, None)
+        if rec is not None and rec[0] == mtime and mtime < fresh_before:
+            children = rec[1]
+            has_meta = rec[2] is not None
+        else:
+            rec = None
+            children = []
+            has_meta = False
+            try:
+                names = os.listdir(p)
+            except OSError:
+                continue
+            for fn in names:
+                fp = path.join(p, fn)
+                if fn == meta_name:
+                    has_meta = True
+                elif path.isdir(fp) and not path.islink(fp):
+                    children.append(fn)
+
+        yield rel, p, mtime, children, has_meta, rec
+        stack.extend(path.join(rel, i) for i in children)
+
+
+def shard_fn(shard):
+    if isinstance(shard, unicode):
+        shard = shard.encode('utf-8')
+    return urllib.quote(shard, '') + '.json'
+
+
+# Index of a set of values per key of a store, with the reverse mapping, the
+# postings: value -> keys having it. Kept in the dir fn: index.json has the
+# values of every key and the mtimes of the dirs of the store, and the
+# postings are split in shards, postings/<shard>.json, so a lookup only
+# reads the ones it needs. Changes are appended to a journal, log, which
+# readers replay on top. It's folded in on flush by a process which rebuilt
+# the index, and by any once it grew past max_journal. Appends and reads
+# hold lock shared and folds exclusive, so the shards and the journal read
+# are of the same fold.
+#
+# Changes made by other means than tagg, a git pull say, are only found by
+# rescan(), which lists the dirs whose mtime changed since the last one.
+class SetIndex(object):
+    version = 3
+    field = 'values'  # Name of the mapping in index.json
+    max_journal = 256 * 1024
+
+    def __init__(self, store, fn=None):
+        self.store = store
+        self.fn = fn
+        self.dirty = False  # Changes which weren't journaled, by rebuild()
+        self._values = None  # key -> set of values, once loaded in full
+        self._keys = None  # value -> set of keys, all or of the shards read
+        self._shards = set()  # Shards read, until loaded in full
+        self._entries = []  # Journal entries replayed on the shards read
+        self._touched = set()  # Shards changed since loaded, None for all
+        self._dirs = None  # dir -> [mtime, children, sig]
+        self._scanned = 0  # When the dirs were last scanned
+        self._dump_stat = None  # Of index.json, to tell it was folded since
+        self._journal_pos = 0  # Offset in the journal read up to
+        self._lock_file = None
+        self._lock_depth = 0
+        store.add_listener(self.on_change)
+
+    def values_of(self, meta):
+        raise NotImplementedError
+
+    def sig_of(self, p, mtime):
+        # Changes with the values of the key in dir p, whose mtime is given.
+        # A list starting with a mtime, None if the key is gone.
+        raise NotImplementedError
+
+    def shard_of(self, value):
+        raise NotImplementedError
+
+    def _path(self, *names):
+        return path.join(self.fn, *names)
+
+    @contextmanager
+    def _locked(self, exclusive=False):
+        # Nested uses keep the lock taken first
+        if self.fn and not self._lock_depth:
+            if self._lock_file is None:
+                if not path.isdir(self.fn):
+                    os.makedirs(self.fn)
+                self._lock_file = open(self._path('lock'), 'a')
+            fcntl.flock(self._lock_file.fileno(),
+                        exclusive and fcntl.LOCK_EX or fcntl.LOCK_SH)
+        self._lock_depth += 1
+        try:
+            yield
+        finally:
+            self._lock_depth -= 1
+            if self.fn and not self._lock_depth:
+                fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_UN)
+
+    def load(self):
+        # Everything, for the lookups which need all the keys
+        if self._values is not None:
+            return
+
+        from . import load_json
+        data = None
+        with self._locked():
+            stat = self._stat_dump()
+            if stat:
+                try:
+                    with open(self._path('index.json'), 'r') as f:
+                        data = load_json(f)
+                except ValueError:
+                    data = None
+
+            if data and data.get('version') == self.version:
+                self._set_values(dict((k, set(v)) for k, v in
+                                      data[self.field].iteritems()))
+                self._dirs = data['dirs']
+                self._scanned = data['scanned']
+                self._dump_stat = stat
+                self._journal_pos = 0
+                self._replay()
+                return
+
+        self.rebuild()
+
+    def rebuild(self):
+        # From the store alone. The journal so far is what's on disk already,
+        # what's appended from now on is replayed on save.
+        with self._locked():
+            self._dump_stat = self.fn and self._stat_dump() or None
+            self._journal_pos = self._journal_size()
+        self._set_values({})
+        self._touched = None
+        self._dirs = {}
+        self._walk(0)
+        self.dirty = True
+
+    def rescan(self):
+        # Catches up with the journal and lists the dirs whose mtime changed
+        # since the last scan. What it finds is journaled, for the other
+        # processes.
+        if self._values is not None and self.fn:
+            with self._locked():
+                if self._stat_dump() != self._dump_stat:
+                    self._values = None  # Folded by another process
+                else:
+                    self._replay()
+        self.load()
+        self._walk(self._scanned, self._journal)
+
+    def read(self, shards):
+        # Reads the postings of shards, and replays the journal on all the
+        # ones read. Everything once loaded in full.
+        if self._values is not None:
+            return
+        if self.fn:
+            with self._locked():
+                stat = self._stat_dump()
+                if stat and self._read(stat, shards):
+                    return
+        self.load()
+
+    def _read(self, stat, shards):
+        from . import load_json
+        if stat != self._dump_stat:
+            # Folded since the shards were read
+            self._keys = {}
+            self._shards = set()
+            self._entries = []
+            self._journal_pos = 0
+            self._dump_stat = stat
+        self._replay()
+
+        shards = set(shards) - self._shards
+        values = set()
+        for shard in shards:
+            try:
+                with open(self._path('postings', shard_fn(shard)), 'r') as f:
+                    data = load_json(f)
+            except IOError:
+                continue  # None of its values has keys
+            except ValueError:
+                return False
+            if data.get('version') != self.version:
+                return False
+            for value, keys in data['values'].iteritems():
+                self._keys[value] = set(keys)
+                values.add(value)
+        self._shards |= shards
+        self._replay_on(shards, values, self._entries)
+        return True
+
+    def save(self):
+        if not self.fn or not self.dirty and \
+                self._journal_size() <= self.max_journal:
+            return
+
+        with self._locked(True):
+            if self._values is not None and \
+                    self._stat_dump() != self._dump_stat:
+                # Folded by another process since it was loaded. The changes
+                # made here were journaled, so they are in what's on disk.
+                self._values = None
+            if self._values is None:
+                self.load()
+            else:
+                self._replay()
+
+            self._write_shards(self._touched)
+            atomic_json_dump({
+                'version': self.version,
+                self.field: dict((k, sorted(v))
+                                 for k, v in self._values.iteritems()),
+                'dirs': self._dirs,
+                'scanned': self._scanned,
+            }, self._path('index.json'))
+            if path.isfile(self._path('log')):
+                os.unlink(self._path('log'))
+            self._dump_stat = self._stat_dump()
+            self._journal_pos = 0
+            self._touched = set()
+            self.dirty = False
+
+    def _write_shards(self, shards):
+        # shards None for all of them, the stale ones removed
+        d = self._path('postings')
+        fns = set(shard_fn(i) for i in shards or ())
+        if shards is None and path.isdir(d):
+            fns = set(os.listdir(d))
+
+        data = {}
+        for value, keys in self._keys.iteritems():
+            shard = self.shard_of(value)
+            if shards is None or shard in shards:
+                data.setdefault(shard, {})[value] = sorted(keys)
+        for shard, values in data.iteritems():
+            atomic_json_dump({'version': self.version, 'values': values},
+                             path.join(d, shard_fn(shard)))
+            fns.discard(shard_fn(shard))
+
+        for fn in fns:
+            if path.isfile(path.join(d, fn)):
+                os.unlink(path.join(d, fn))
+
+    def _stat_dump(self):
+        try:
+            st = os.stat(self._path('index.json'))
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime)
+
+    def _journal_size(self):
+        if not self.fn:
+            return 0
+        try:
+            return os.stat(self._path('log')).st_size
+        except OSError:
+            return 0
+
+    def _walk(self, scanned, change=None):
+        # Gets the values of the keys whose sig changed since the scan made
+        # at time scanned from the store again, with change(op, key, value)
+        # or applied if None. Unchanged ones cost a stat() or two.
+        change = change or self._apply
+        old, self._dirs = self._dirs, {}
+        # mtimes this close to the last scan may hide later changes
+        fresh_before = scanned - 1
+        self._scanned = time.time()
+        found = set()
+        for rel, p, mtime, children, has_meta, rec in scan_dirs(
+                self.store.root, self.store.meta_name, old, fresh_before):
+            sig = has_meta and self.sig_of(p, mtime) or None
+            if sig:
+                found.add(rel)
+                if rec is None or rec[2] != sig or sig[0] >= fresh_before:
+                    values = self.values_of(self.store.get(rel))
+                    if set(values) != self._values.get(rel, None):
+                        change('set', rel, values)
+            # After _apply(), which forgets the dirs of the keys it changes
+            self._dirs[rel] = [mtime, children, sig]
+
+        for key in set(self._values) - found:
+            change('del', key)
+
+    def _set_values(self, values):
+        self._values = values
+        self._keys = {}
+        self._shards = set()
+        self._entries = []
+        self._touched = set()
+        for key, v in values.iteritems():
+            for value in v:
+                self._keys.setdefault(value, set()).add(key)
+
+    def _replay(self):
+        # Applies the entries appended to the journal since the last replay.
+        # Replaying the entries of this process again is harmless: each sets
+        # the values it touches, so the last one in the journal wins.
+        fn = self.fn and self._path('log')
+        if not fn or not path.isfile(fn):
+            return
+        entries = []
+        with open(fn, 'r') as f:
+            f.seek(self._journal_pos)
+            for line in iter(f.readline, ''):
+                if not line.endswith('\n'):
+                    break  # Still being written, read on the next replay
+                self._journal_pos = f.tell()
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # A torn write from an interrupted process
+                    continue
+
+        if self._values is not None:
+            for entry in entries:
+                self._apply(*entry)
+        else:
+            # Kept for the shards read later
+            self._entries.extend(entries)
+            self._replay_on(self._shards, set(self._keys), entries)
+
+    def _replay_on(self, shards, values, entries):
+        # Applies the entries to the postings of shards, whose values read
+        # are given
+        for entry in entries:
+            op, key = entry[:2]
+            if op in ('link', 'unlink'):
+                if self.shard_of(entry[2]) not in shards:
+                    continue
+                if op == 'link':
+                    self._add(entry[2], key)
+                    values.add(entry[2])
+                else:
+                    self._discard(entry[2], key)
+                continue
+
+            new = set(entry[2]) if op == 'set' else ()
+            for i in values:
+                if i not in new:
+                    self._discard(i, key)
+            for i in new:
+                if self.shard_of(i) in shards:
+                    self._add(i, key)
+                    values.add(i)
+
+    def _journal(self, *entry):
+        if self._values is not None:
+            self._apply(*entry)
+
+        # Only for an index built already, by this process or another
+        if not self.fn or not path.isdir(self.fn):
+            return
+        with self._locked():
+            with open(self._path('log'), 'a') as f:
+                f.write(json.dumps(entry) + '\n')
+
+    def _apply(self, op, key, value=None):
+        # On the index loaded in full
+        if self._dirs is not None:
+            # Rescanned on the next scan, to save its new sig
+            self._dirs.pop(key, None)
+
+        if op == 'link':
+            self._values.setdefault(key, set()).add(value)
+            self._add(value, key)
+        elif op == 'unlink':
+            self._values.get(key, set()).discard(value)
+            self._discard(value, key)
+        elif op == 'set':
+            self._apply('del', key)
+            self._values[key] = set(value)
+            for i in value:
+                self._add(i, key)
+        elif op == 'del':
+            for i in self._values.pop(key, ()):
+                self._discard(i, key)
+
+    def _add(self, value, key):
+        self._keys.setdefault(value, set()).add(key)
+        if self._touched is not None:
+            self._touched.add(self.shard_of(value))
+
+    def _discard(self, value, key):
+        keys = self._keys.get(value)
+        if keys is not None and key in keys:
+            keys.discard(key)
+            if not keys:
+                del self._keys[value]
+            if self._touched is not None:
+                self._touched.add(self.shard_of(value))
+
+    def on_change(self, ev, **kwargs):
+        if ev == 'flush':
+            self.save()
+
+    def keys(self):
+        self.load()
+        return set(self._values)
+
+    def backlinks(self, value):
+        # The keys having value. Not to be changed.
+        self.read([self.shard_of(value)])
+        return self._keys.get(value, set())
+
+
+# Reverse index of the links in a store: link key -> keys linking to it. A
+# shard per link key.
+class LinkIndex(SetIndex):
+    field = 'links'
+
+    def values_of(self, meta):
+        return [i.key for i in meta.links]
+
+    def sig_of(self, p, mtime):
+        # Links are added and removed in the dir
+        return [mtime]
+
+    def shard_of(self, value):
+        return value
+
+    def on_change(self, ev, key=None, link=None, new_key=None, **kwargs):
+        if ev == 'add_link' and link:
+            self._journal('link', key, link.key)
+        elif ev == 'remove_link' and link:
+            self._journal('unlink', key, link.key)
+        elif ev == 'add_key':
+            self._journal('set', key, [])
+        elif ev == 'remove_key':
+            self._journal('del', key)
+        elif ev == 'rename_key':
+            self._journal('del', key)
+            m = self.store.get(new_key)
+            if m.exists:
+                self._journal('set', new_key, self.values_of(m))
+        else:
+            super(LinkIndex, self).on_change(ev, **kwargs)
+
+    def find(self, links):
+        if not links:
+            self.load()
+            return sorted(self._values)
+
+        self.read(self.shard_of(i.key) for i in links)
+        keys = None
+        for link in links:
+            tmp = self._keys.get(link.key, set())
+            keys = tmp if keys is None else keys & tmp
+
+        # Drop links removed behind our back. Only costs a lstat per result.
+        ret = []
+        for key in sorted(keys):
+            p = self.store.get_path(key)
+            if all(path.islink(path.join(p, i.name)) for i in links):
+                ret.append(key)
+        return ret
+
+
+# Inverted index of the tokens of the name and description of each key, as
+# matched by Meta.match_keywords: token -> keys. A shard per first two
+# letters of the tokens.
+class TokenIndex(SetIndex):
+    field = 'tokens'
+
+    def __init__(self, *args, **kwargs):
+        super(TokenIndex, self).__init__(*args, **kwargs)
+        self._sorted = None  # Sorted tokens, for prefix lookups
+
+    def values_of(self, meta):
+        return sorted(i for i in meta.tokens() if i)
+
+    def sig_of(self, p, mtime):
+        try:
+            st = os.stat(path.join(p, self.store.meta_name))
+        except OSError:
+            return None
+        return [st.st_mtime, st.st_size]
+
+    def shard_of(self, value):
+        return value[:2]
+
+    def _set_values(self, values):
+        super(TokenIndex, self)._set_values(values)
+        self._sorted = None
+
+    def _apply(self, *entry):
+        super(TokenIndex, self)._apply(*entry)
+        self._sorted = None
+
+    def on_change(self, ev, key=None, meta=None, **kwargs):
+        if ev == 'save_meta':
+            self._journal('set', key, self.values_of(meta))
+        elif ev in ('remove_key', 'rename_key'):
+            # The new key of a rename was saved already
+            self._journal('del', key)
+        else:
+            super(TokenIndex, self).on_change(ev, **kwargs)
+
+    def lookup(self, term):
+        # Keys having a token, or any token starting with it if it ends
+        # with *
+        term = term.lower()
+        if not term.endswith('*'):
+            self.read([self.shard_of(term)])
+            return self._keys.get(term, set())
+
+        prefix = term[:-1]
+        if len(prefix) < 2:
+            self.load()  # Spread over many shards
+        else:
+            self.read([self.shard_of(prefix)])
+
+        if self._values is None:
+            # The few tokens of the shard read
+            tokens = sorted(i for i in self._keys if i.startswith(prefix))
+        else:
+            if self._sorted is None:
+                self._sorted = sorted(self._keys)
+            tokens = self._sorted[bisect_left(self._sorted, prefix):]
+
+        ret = set()
+        for token in tokens:
+            if not token.startswith(prefix):
+                break
+            ret |= self._keys[token]
+        return ret
+
+    def search(self, keywords):
+        # Keys matching any of the keywords. A keyword made of terms joined
+        # by + matches the keys having all of them.
+        ret = set()
+        for keyword in keywords:
+            keys = None
+            for term in keyword.split('+'):
+                tmp = self.lookup(term.strip())
+                keys = tmp if keys is None else keys & tmp
+            ret |= keys
+        return sorted(ret)
+
+
+# Append-only log of the keys removed from a store, renamed ones included,
+# so incremental exports can tell consumers about them
+class TombstoneLog(object):
+    def __init__(self, store, fn):
+        self.store = store
+        self.fn = fn
+        store.add_listener(self.on_change)
+
+    def on_change(self, ev, key=None, **kwargs):
+        if ev in ('remove_key', 'rename_key'):
+            self.add(key)
+
+    def add(self, key):
+        from . import timestamp
+        d = path.dirname(self.fn)
+        if d and not path.isdir(d):
+            os.makedirs(d)
+        with open(self.fn, 'a') as f:
+            f.write(json.dumps({'key': key, 'at': timestamp()}) + '\n')
+
+    def since(self, ts):
+        keys = set()
+        if not path.isfile(self.fn):
+            return keys
+        with open(self.fn, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry['at'] > ts:
+                    keys.add(entry['key'])
+        return keys
+
+
+class _TrieNode(object):
+    __slots__ = ('children', 'sorted', 'is_key')
+
+    def __init__(self):
+        self.children = {}
+        self.sorted = None  # Sorted names of the children, built on demand
+        self.is_key = False
+
+    def names(self):
+        if self.sorted is None:
+            self.sorted = sorted(self.children)
+        return self.sorted
+
+
+# Trie of the keys of a store, one level per path segment, for completion.
+# Built on first use and then kept up to date from the store events. With
+# unique, the last segments of the keys are completed on their own too, as
+# UniqueCachedMetaStore finds a key by them.
+class KeyTrie(object):
+    def __init__(self, store, unique=False):
+        self.store = store
+        self.unique = unique
+        self.root = None
+        self._names = None  # last segment -> number of keys ending with it
+        self._sorted_names = None
+        store.add_listener(self.on_change)
+
+    def load(self):
+        if self.root is not None:
+            return
+        self.root = _TrieNode()
+        self._names = {}
+        for key in self.store.keys():
+            self.add(key)
+
+    def on_change(self, ev, key=None, new_key=None, **kwargs):
+        if self.root is None:
+            return
+        if ev == 'add_key':
+            self.add(key)
+        elif ev == 'remove_key':
+            self.remove(key)
+        elif ev == 'rename_key':
+            self.remove(key)
+            self.add(new_key)
+
+    def add(self, key):
+        node = self.root
+        for seg in key.lower().split('/'):
+            child = node.children.get(seg, None)
+            if child is None:
+                child = node.children[seg] = _TrieNode()
+                node.sorted = None
+            node = child
+        if not node.is_key:
+            node.is_key = True
+            name = path.basename(key.lower())
+            self._names[name] = self._names.get(name, 0) + 1
+            self._sorted_names = None
+
+    def remove(self, key):
+        nodes = [self.root]
+        segs = key.lower().split('/')
+        for seg in segs:
+            node = nodes[-1].children.get(seg, None)
+            if node is None:
+                return
+            nodes.append(node)
+        if not nodes[-1].is_key:
+            return
+
+        nodes[-1].is_key = False
+        name = segs[-1]
+        self._names[name] -= 1
+        if not self._names[name]:
+            del self._names[name]
+            self._sorted_names = None
+
+        # Prune the nodes left with neither keys nor children
+        for i in xrange(len(segs), 0, -1):
+            node = nodes[i]
+            if node.is_key or node.children:
+                break
+            del nodes[i - 1].children[segs[i - 1]]
+            nodes[i - 1].sorted = None
+
+    def find(self, key):
+        node = self.root
+        for seg in key.split('/') if key else []:
+            node = node.children.get(seg, None)
+            if node is None:
+                return None
+        return node
+
+    def complete(self, prefix, fuzzy_limit=50):
+        # Keys or dirs on the level of prefix starting with its last segment,
+        # then the ones with its letters in the same order, as fuzzy matches
+        if len(prefix) < 1:
+            return []
+        self.load()
+        prefix = prefix.lower()
+        o = path.dirname(prefix)
+        name = path.basename(prefix)
+        node = self.find(o)
+        if node is None:
+            return []
+
+        candidates = [node.names()]
+        if not o and self.unique:
+            if self._sorted_names is None:
+                self._sorted_names = sorted(self._names)
+            candidates.append(self._sorted_names)
+
+        ret = []
+        seen = set()
+        for names in candidates:
+            for i in xrange(bisect_left(names, name), len(names)):
+                if not names[i].startswith(name):
+                    break
+                if names[i] not in seen:
+                    seen.add(names[i])
+                    ret.append(path.join(o, names[i]))
+
+        fuzzy = re.compile('.*'.join(re.escape(i) for i in name))
+        found = 0
+        for names in candidates:
+            for i in names:
+                if found >= fuzzy_limit:
+                    break
+                if i not in seen and fuzzy.search(i):
+                    seen.add(i)
+                    ret.append(path.join(o, i))
+                    found += 1
+        return ret
@@ -0,0 +1,235 @@
+import __builtin__
+import os
+import sys
+import json
+import shutil
+import threading
+import time
+import types
+import os.path as path
+from contextlib import contextmanager
+
+
+# Filesystem calls counted and timed while a Profiler is installed, as
+# (module, attribute) pairs
+fs_ops = [
+    (os, 'listdir'), (os, 'walk'), (os, 'stat'), (os, 'lstat'),
+    (os, 'readlink'), (os, 'symlink'), (os, 'unlink'), (os, 'rename'),
+    (os, 'makedirs'), (os, 'utime'),
+    (path, 'isdir'), (path, 'isfile'), (path, 'islink'), (path, 'exists'),
+    (path, 'realpath'),
+    (shutil, 'rmtree'),
+    (__builtin__, 'open'),
+    (json, 'load'),
+]
+
+# MetaStore methods timed per store. Ops run from them are attributed to the
+# store which called them.
+store_methods = [
+    'get', 'load_meta', 'save_meta', 'get_linked', 'keys', 'find_links',
+    'find_keywords', 'link_stats', 'add_key', 'remove_key', 'rename_key',
+    'add_link', 'remove_link', 'validate', 'cache_all', 'commit_batch',
+    'rescan',
+]
+
+
+class Profiler(object):
+    # Counts and times the filesystem calls made by tagg, per cmd and per
+    # store, along with the calls of the store methods they came from and
+    # the cache hits of the stores. Only the calls made from the thread that
+    # installed it are recorded.
+    def __init__(self):
+        self.ops = {}  # (cmd, store, op) -> [calls, seconds]
+        self.methods = {}  # (cmd, store, method) -> [calls, seconds]
+        self.stores = {}  # name -> store, for their cache stats
+        self.active = set()  # (store, method) being timed
+        self.current_cmd = None
+        self.current_store = None
+        self.local = threading.local()
+        self.thread = None
+        self.originals = []
+
+    def install(self):
+        from . import MetaStore
+        self.thread = threading.current_thread()
+        for mod, name in fs_ops:
+            self._patch(mod, name, self._wrap_op(name, getattr(mod, name)))
+
+        classes = [MetaStore]
+        for cls in classes:
+            classes.extend(cls.__subclasses__())
+            for name in store_methods:
+                if name in cls.__dict__:
+                    self._patch(cls, name,
+                                self._wrap_method(name, cls.__dict__[name]))
+
+    def _patch(self, obj, name, func):
+        self.originals.append((obj, name, getattr(obj, name)))
+        setattr(obj, name, func)
+
+    def uninstall(self):
+        for obj, name, func in reversed(self.originals):
+            if isinstance(func, types.MethodType):
+                func = func.im_func
+            setattr(obj, name, func)
+        self.originals = []
+
+    @contextmanager
+    def cmd(self, name):
+        prev = self.current_cmd
+        self.current_cmd = name
+        try:
+            yield
+        finally:
+            self.current_cmd = prev
+
+    def _record(self, table, key, elapsed):
+        rec = table.get(key, None)
+        if rec is None:
+            rec = table[key] = [0, 0.0]
+        rec[0] += 1
+        rec[1] += elapsed
+
+    def _timed(self, table, key, func, args, kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self._record(table, key, time.time() - start)
+
+    def _wrap_op(self, name, func):
+        def _wrapped(*args, **kwargs):
+            local = self.local
+            if getattr(local, 'in_op', False) or \
+                    threading.current_thread() is not self.thread:
+                # Nested calls are part of the outer op, realpath calling
+                # islink for instance
+                return func(*args, **kwargs)
+
+            key = (self.current_cmd, self.current_store, name)
+            local.in_op = True
+            try:
+                ret = self._timed(self.ops, key, func, args, kwargs)
+            finally:
+                local.in_op = False
+            if isinstance(ret, types.GeneratorType):
+                return self._timed_iter(self.ops, key, ret)
+            return ret
+
+        return _wrapped
+
+    def _wrap_method(self, name, func):
+        def _wrapped(store, *args, **kwargs):
+            key = (store.name, name)
+            if key in self.active or \
+                    threading.current_thread() is not self.thread:
+                # Overrides calling their base are timed once
+                return func(store, *args, **kwargs)
+
+            self.stores[store.name] = store
+            with self._in_method(key):
+                ret = self._timed(self.methods, (self.current_cmd,) + key,
+                                  func, (store,) + args, kwargs)
+            if isinstance(ret, types.GeneratorType):
+                return self._timed_method_iter(key, ret)
+            return ret
+
+        _wrapped.__name__ = name
+        return _wrapped
+
+    @contextmanager
+    def _in_method(self, key):
+        prev = self.current_store
+        self.current_store = key[0]
+        self.active.add(key)
+        try:
+            yield
+        finally:
+            self.active.discard(key)
+            self.current_store = prev
+
+    def _timed_iter(self, table, key, it):
+        # The work of generators like os.walk() happens while they are
+        # iterated, not when they are called
+        local = self.local
+        while True:
+            local.in_op = True
+            start = time.time()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                table[key][1] += time.time() - start
+                local.in_op = False
+            yield item
+
+    def _timed_method_iter(self, key, it):
+        # Same for the store methods like keys()
+        table_key = (self.current_cmd,) + key
+        while True:
+            start = time.time()
+            try:
+                with self._in_method(key):
+                    item = next(it)
+            except StopIteration:
+                return
+            finally:
+                self.methods[table_key][1] += time.time() - start
+            yield item
+
+    def summary(self):
+        return {
+            'ops': [dict(zip(('cmd', 'store', 'op', 'calls', 'seconds'),
+                             k + tuple(v)))
+                    for k, v in sorted(self.ops.items())],
+            'methods': [dict(zip(('cmd', 'store', 'method', 'calls',
+                                  'seconds'), k + tuple(v)))
+                        for k, v in sorted(self.methods.items())],
+            'stores': dict((k, dict(s.stats))
+                           for k, s in self.stores.iteritems()),
+        }
+
+    def dump(self, fn):
+        with open(fn, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+
+    def report(self, out=None):
+        out = out or sys.stderr
+        def table_print(title, table):
+            print >> out, title
+            print >> out, '  %-24s %-14s %-14s %9s %10s' % (
+                'cmd', 'store', 'name', 'calls', 'seconds')
+            for k, (calls, seconds) in sorted(table.items(),
+                                              key=lambda i: -i[1][1]):
+                cmd, store, name = k
+                print >> out, '  %-24s %-14s %-14s %9d %10.4f' % (
+                    cmd or '-', store or '-', name, calls, seconds)
+
+        table_print('Filesystem ops:', self.ops)
+        table_print('Store methods (including the calls they make):',
+                    self.methods)
+        for name, s in sorted(self.stores.items()):
+            if s.stats:
+                print >> out, '%s: %s' % (name, ', '.join(
+                    '%s=%d' % i for i in sorted(s.stats.items())))
+
+
+@contextmanager
+def profiling(enabled=True, dump=None, out=None):
+    # Yields a Profiler, installed only if enabled or dumping, and reports on
+    # it when done
+    profiler = Profiler()
+    if not enabled and not dump:
+        yield profiler
+        return
+
+    profiler.install()
+    try:
+        yield profiler
+    finally:
+        profiler.uninstall()
+        if enabled:
+            profiler.report(out)
+        if dump:
+            profiler.dump(dump)
@@ -0,0 +1,140 @@
+import re
+from fnmatch import fnmatchcase
+
+
+# Boolean queries over the links of a store, like
+#   language/python & (general/django | general/flask) & !general/original
+# , is the same as &, and a tag with * or ? in it matches every tag like it,
+# brand/* for instance. & binds tighter than |, ! tighter than both.
+token_re = re.compile(r'\s*(?:([&|!(),])|([^\s&|!(),]+))')
+query_chars = set('&|!()*?')
+
+
+def is_query(s):
+    # Whether s needs the query engine, rather than being a , list of tags
+    return bool(query_chars & set(s))
+
+
+def tokenize(expr):
+    from . import Error
+    tokens = []
+    pos = 0
+    expr = expr.rstrip()
+    while pos < len(expr):
+        m = token_re.match(expr, pos)
+        if not m:
+            raise Error('Invalid query %s at %d' % (expr, pos))
+        op, name = m.groups()
+        tokens.append(op == ',' and '&' or op or ('tag', name))
+        pos = m.end()
+    return tokens
+
+
+def parse_query(expr):
+    # Returns the tree of ('or', [nodes]), ('and', [nodes]), ('not', node)
+    # and ('tag', name) nodes of expr
+    from . import Error
+    tokens = tokenize(expr)
+    pos = [0]
+
+    def unexpected(t):
+        return Error('Invalid query %s: unexpected %s' % (
+            expr, isinstance(t, tuple) and t[1] or t))
+
+    def peek():
+        return tokens[pos[0]] if pos[0] < len(tokens) else None
+
+    def take(expected=None):
+        t = peek()
+        if t is None or (expected and t != expected):
+            raise Error('Invalid query %s: expected %s' % (
+                expr, expected or 'a tag'))
+        pos[0] += 1
+        return t
+
+    def parse_or():
+        nodes = [parse_and()]
+        while peek() == '|':
+            take()
+            nodes.append(parse_and())
+        return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+    def parse_and():
+        nodes = [parse_not()]
+        while peek() == '&':
+            take()
+            nodes.append(parse_not())
+        return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+    def parse_not():
+        if peek() == '!':
+            take()
+            return ('not', parse_not())
+        return parse_atom()
+
+    def parse_atom():
+        t = take()
+        if t == '(':
+            node = parse_or()
+            take(')')
+            return node
+        if not isinstance(t, tuple):
+            raise unexpected(t)
+        return t
+
+    node = parse_or()
+    if peek() is not None:
+        raise unexpected(peek())
+    return node
+
+
+class QueryEvaluator(object):
+    # Evaluates a parsed query with set algebra over a LinkIndex. The keys of
+    # the index are the universe ! is taken against.
+    def __init__(self, index, tagstore):
+        self.index = index
+        self.tagstore = tagstore
+        self._universe = None
+
+    def universe(self):
+        if self._universe is None:
+            self._universe = self.index.keys()
+        return self._universe
+
+    def tag_keys(self, name):
+        from . import Error
+        if '*' in name or '?' in name:
+            name = name.lower()
+            return [k for k in self.tagstore.keys() if fnmatchcase(k, name)]
+
+        tag = self.tagstore.get(name)
+        if not tag or not tag.exists:
+            raise Error("Tag %s doesn't exist" % name)
+        return [tag.key]
+
+    def eval(self, node):
+        op, arg = node
+        if op == 'tag':
+            ret = set()
+            for key in self.tag_keys(arg):
+                ret |= self.index.backlinks(key)
+            return ret
+        elif op == 'or':
+            ret = set()
+            for i in arg:
+                ret |= self.eval(i)
+            return ret
+        elif op == 'not':
+            return self.universe() - self.eval(arg)
+
+        # and: intersect the positive terms, smallest first, then take the
+        # negative ones away without going through the universe
+        positives = sorted((self.eval(i) for i in arg if i[0] != 'not'),
+                           key=len)
+        negatives = [self.eval(i[1]) for i in arg if i[0] == 'not']
+        ret = positives[0] if positives else self.universe()
+        for i in positives[1:]:
+            ret = ret & i
+        for i in negatives:
+            ret = ret - i
+        return ret
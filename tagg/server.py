@@ -0,0 +1,170 @@
+import os
+import sys
+import json
+import signal
+import socket
+import traceback
+import SocketServer
+import os.path as path
+
+from . import Error
+from . import cli as _tag
+from .client import connect, socket_path, local_cmds
+from .instrument import profiling
+
+
+class RunLocally(Exception):
+    # The cmd reads the stdin of the client
+    pass
+
+
+class ClientGone(Exception):
+    # The client closed the connection, the output has nowhere to go
+    pass
+
+
+class StreamWriter(object):
+    # Sends what's written to it to the client as the 'out' or 'err' of
+    # reply lines, in chunks, so the output of a cmd like export is not held
+    # whole and the client writes it as it comes
+    chunk_size = 64 * 1024
+
+    def __init__(self, wfile, name):
+        self.wfile = wfile
+        self.name = name
+        self.buf = []
+        self.size = 0
+        self.softspace = 0
+
+    def write(self, s):
+        s = decode(s)
+        self.buf.append(s)
+        self.size += len(s)
+        if self.size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buf:
+            return
+        chunk = u''.join(self.buf)
+        self.buf = []
+        self.size = 0
+        try:
+            self.wfile.write(json.dumps({self.name: chunk}) + '\n')
+        except socket.error:
+            raise ClientGone()
+
+
+class TaggServer(SocketServer.UnixStreamServer):
+    # Runs the cmds sent by tagg.client with the stores of one data dir kept
+    # loaded, one at a time. Like piped cmds, confirmations are answered yes.
+    # Before each cmd, the stores catch up with the changes made by other
+    # processes, tagg or not, from the mtimes of the dirs and the journals of
+    # the indexes.
+    def __init__(self, data_dir, parser):
+        self.data_dir = path.abspath(data_dir)
+        self.parser = parser
+        self.targets = _tag.get_targets(self.data_dir)
+        _tag.rescan_targets(self.targets)
+        self.fn = socket_path(self.data_dir)
+
+        if path.exists(self.fn):
+            sock = connect(self.fn)
+            if sock:
+                sock.close()
+                raise Error('A server is running on %s already' % self.fn)
+            os.unlink(self.fn)  # Left by one which died
+        if not path.isdir(path.dirname(self.fn)):
+            os.makedirs(path.dirname(self.fn))
+        SocketServer.UnixStreamServer.__init__(self, self.fn, RequestHandler)
+
+    def run(self, argv, tty):
+        opts, argv = _tag.split_profile_args(argv)
+        if not tty and _tag.is_piped(self.parser, argv):
+            raise RunLocally()
+
+        args = self.parser.parse_args(argv)
+        if not tty and args.subcmd in ('tag-many', 'untag-many') and \
+                not args.value:
+            raise RunLocally()  # The repo keys are piped in
+        if path.abspath(args.data_dir) != self.data_dir:
+            raise Error('This server is for %s' % self.data_dir)
+        if args.cmd in local_cmds or args.subcmd in local_cmds:
+            raise Error("%s can't be run by the server" % args.cmd)
+
+        with profiling(opts.profile, opts.profile_dump) as profiler:
+            with profiler.cmd('rescan'):
+                _tag.rescan_targets(self.targets)
+            _tag.run_cmd(self.targets, args, None, profiler,
+                         _tag.NoConfirmSession())
+
+    def close(self):
+        self.server_close()
+        if path.exists(self.fn):
+            os.unlink(self.fn)
+        _tag.flush_targets(self.targets)
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    # Replies with lines of 'out' and 'err' chunks, then one of the exit
+    # 'code', or with a single one of 'local'
+    def handle(self):
+        req = json.loads(self.rfile.readline())
+        out = StreamWriter(self.wfile, 'out')
+        err = StreamWriter(self.wfile, 'err')
+        cwd = os.getcwd()
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = out, err
+        code = 0
+        try:
+            # Paths in the cmds are relative to the client
+            os.chdir(req.get('cwd', cwd))
+            self.server.run(req['argv'], req.get('tty', True))
+        except RunLocally:
+            self.wfile.write(json.dumps({'local': True}) + '\n')
+            return
+        except ClientGone:
+            return
+        except SystemExit, e:
+            code = e.code
+            if code is not None and not isinstance(code, int):
+                print >> err, code
+                code = 1
+        except Exception:
+            traceback.print_exc(file=err)
+            code = 1
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+            os.chdir(cwd)
+
+        try:
+            out.flush()
+            err.flush()
+            self.wfile.write(json.dumps({'code': code or 0}) + '\n')
+        except (ClientGone, socket.error):
+            pass
+
+    def finish(self):
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error:
+            pass  # What's left can't be sent to a client which is gone
+
+
+def decode(s):
+    if isinstance(s, str):
+        return s.decode('utf-8', 'replace')
+    return s
+
+
+def serve(data_dir, parser):
+    server = TaggServer(data_dir, parser)
+    print >> sys.stderr, 'Serving %s on %s' % (server.data_dir, server.fn)
+    # Stopped by kill as well as ^C, cleaning up the same way
+    signal.signal(signal.SIGTERM, lambda *a: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
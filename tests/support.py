@@ -0,0 +1,72 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+from contextlib import contextmanager
+from StringIO import StringIO
+
+from tagg import cli as _tag
+from tagg.instrument import Profiler
+
+
+class DataDirTestCase(unittest.TestCase):
+    # Runs each test in a fresh data dir with the tags and repos below, the
+    # repos tagged with the tags listed with them
+    tags = ['language/python', 'general/web', 'brand/x']
+    repos = {
+        'a/b': ['language/python', 'general/web'],
+        'c/d': ['language/python'],
+        'e/f': [],
+    }
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp(prefix='tagg-test-')
+        self.addCleanup(shutil.rmtree, self.data_dir, True)
+        targets = _tag.get_targets(self.data_dir)
+        for key in self.tags:
+            targets['tags'].add_key(key)
+        for key, tags in sorted(self.repos.items()):
+            targets['repos'].add_key(key, {'description': key})
+            for tag in tags:
+                targets['repos'].add_link(key, targets['tags'].get(tag))
+        _tag.flush_targets(targets)
+
+    def targets(self):
+        # Loaded afresh, to see what the cmds left on disk
+        return _tag.get_targets(self.data_dir)
+
+    def exists(self, store, key):
+        return self.targets()[store].get(key).exists
+
+    def backdate(self, seconds=60):
+        # Makes everything in the data dir old enough for the mtimes kept by
+        # the caches to be trusted
+        old = time.time() - seconds
+        for dirpath, dirnames, filenames in os.walk(self.data_dir):
+            for i in dirnames + filenames:
+                os.utime(os.path.join(dirpath, i), (old, old))
+
+    @contextmanager
+    def in_data_dir(self):
+        cwd = os.getcwd()
+        os.chdir(self.data_dir)
+        try:
+            yield
+        finally:
+            os.chdir(cwd)
+
+    def pipe(self, lines):
+        # Runs lines like `cat lines | tagg` in the data dir. Returns the
+        # lines printed.
+        out = StringIO()
+        stdout, sys.stdout = sys.stdout, out
+        try:
+            with self.in_data_dir():
+                _tag.run_piped(_tag.make_parser(), [],
+                               StringIO(''.join(i + '\n' for i in lines)),
+                               Profiler())
+        finally:
+            sys.stdout = stdout
+        return out.getvalue().splitlines()
@@ -0,0 +1,104 @@
+import re
+import unittest
+
+from tagg.autotag import PatternSet, AutoTagger, ImmediateActions
+
+from .support import DataDirTestCase
+
+
+names = ['django', 'py-django', 'pyramid', 'flask', 'Flask-Login', 'aa',
+         'abab', 'redis-py', 'go', 'gogo', 'node', 'nodejs', 'x', '',
+         'django-rest-framework', 'pypy', 'zzz', '123', 'a.b']
+
+
+class PatternSetTest(unittest.TestCase):
+    def assertSameMatches(self, patterns):
+        # As each of the patterns matched on its own, in any order
+        ps = PatternSet(patterns)
+        for name in names:
+            self.assertEqual(sorted(ps.match(name)),
+                             sorted(v for v, p in patterns if p.match(name)),
+                             name)
+        return ps
+
+    def compile(self, patterns, flags=0):
+        return [(i, re.compile(p, flags)) for i, p in enumerate(patterns)]
+
+    def test_fused(self):
+        ps = self.assertSameMatches(self.compile([
+            '^django$', '^py', 'py$', 'fl(a|o)sk', '(go)+$', 'node(js)?',
+            r'\w\.\w', '[0-9]+', '.*rest.*', 'a*', 'x|y', '(?:ab){2}',
+            '',
+        ]))
+        self.assertEqual(len(ps.chunks), 1)
+        self.assertEqual(ps.fallback, [])
+
+    def test_same_value_twice(self):
+        # Patterns match at the start of the name, like re.match
+        patterns = self.compile(['py', 'pyp'])
+        patterns = [(0, p) for i, p in patterns]
+        ps = PatternSet(patterns)
+        self.assertEqual(ps.match('pypy'), [0, 0])
+        self.assertEqual(ps.match('pyramid'), [0])
+        self.assertEqual(ps.match('redis-py'), [])
+
+    def test_chunks(self):
+        # Two groups each, a regex holds 49 of them
+        letters = 'abcdefghijklmnopqrstuvwxyz'
+        patterns = self.compile(['^(%s)' % (letters[i % 26] * (i // 26 + 1))
+                                 for i in xrange(150)])
+        ps = self.assertSameMatches(patterns)
+        self.assertEqual(len(ps.chunks), 4)
+        self.assertEqual(ps.fallback, [])
+
+    def test_chunk_cut_by_groups(self):
+        patterns = self.compile(['(a)' * 50, '(b)' * 48, '(z)'])
+        ps = self.assertSameMatches(patterns)
+        self.assertEqual([len(i[1]) for i in ps.chunks], [1, 2])
+
+    def test_fallback(self):
+        unsafe = [r'(a)\1', r'(?P<x>go)(?P=x)', r'(a)?(?(1)a|b)',
+                  '(?i)^flask', '(x)' * 99]
+        patterns = self.compile(['^py', 'go'] + unsafe)
+        patterns.append((len(patterns), re.compile('^FLASK', re.I)))
+        ps = self.assertSameMatches(patterns)
+        self.assertEqual([v for v, p in ps.fallback], range(2, len(patterns)))
+
+    def test_nothing(self):
+        ps = PatternSet([])
+        self.assertEqual(ps.chunks, [])
+        self.assertEqual(ps.match('django'), [])
+
+
+class AutoTagRunTest(DataDirTestCase):
+    def test_saved_repo_by_repo(self):
+        targets = self.targets()
+        repostore = targets['repos']
+        events = []
+        save_meta = repostore.save_meta
+
+        def saved(meta):
+            if repostore._pending is None:  # Written, not buffered
+                events.append(('save', meta.key))
+            return save_meta(meta)
+        repostore.save_meta = saved
+        actions = ImmediateActions(interactive=False)
+        get_repo = actions.get_repo
+        actions.get_repo = lambda store, key: events.append(
+            ('get', key)) or get_repo(store, key)
+
+        tagger = AutoTagger(targets['tags'], repostore, actions)
+        tagger.autotag({'keywords': {'brand/x': ['/.*/']}},
+                       ['a/b', 'c/d', 'e/f'])
+        # Each repo written before the next one is tagged
+        self.assertEqual(events, [('get', 'a/b'), ('save', 'a/b'),
+                                  ('get', 'c/d'), ('save', 'c/d'),
+                                  ('get', 'e/f'), ('save', 'e/f')])
+        targets = self.targets()
+        tag = targets['tags'].get('brand/x')
+        for key in ['a/b', 'c/d', 'e/f']:
+            self.assertTrue(targets['repos'].get(key).has_link(tag), key)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import sys
+import json
+import unittest
+from StringIO import StringIO
+
+from tagg import cli as _tag
+
+from .support import DataDirTestCase
+
+
+class PipedCmdsTest(DataDirTestCase):
+    def test_rename_repo(self):
+        self.pipe(['repos\trename\ta/b\tzz/renamed'])
+        self.assertFalse(self.exists('repos', 'a/b'))
+        self.assertTrue(self.exists('repos', 'zz/renamed'))
+
+    def test_rename_tag(self):
+        self.pipe(['tags\trename\tbrand/x\tbrand/y'])
+        self.assertFalse(self.exists('tags', 'brand/x'))
+        self.assertTrue(self.exists('tags', 'brand/y'))
+
+    def test_rename_linked_tag(self):
+        self.pipe(['tags\trename\tgeneral/web\tgeneral/www'])
+        self.assertTrue(self.exists('tags', 'general/www'))
+        repo = self.targets()['repos'].get('a/b')
+        self.assertEqual(sorted(i.key for i in repo.links),
+                         ['general/www', 'language/python'])
+
+    def test_renamed_tag_listed_and_found(self):
+        # By its full and its short name, by the cmds after it
+        out = self.pipe(['tags\trename\tbrand/x\tbrand/y',
+                         'tags\tlist',
+                         'repos\ttag\te/f\ty'])
+        self.assertIn('brand/y', out)
+        self.assertNotIn('brand/x', out)
+        repo = self.targets()['repos'].get('e/f')
+        self.assertEqual([i.key for i in repo.links], ['brand/y'])
+
+    def test_removed_by_short_name(self):
+        out = self.pipe(['tags\tremove\tx', 'tags\tlist'])
+        self.assertNotIn('brand/x', out)
+        self.assertFalse(self.exists('tags', 'brand/x'))
+
+
+class ManyCmdsTest(DataDirTestCase):
+    def run_cmd(self, *argv):
+        args = _tag.make_parser().parse_args(['-d', self.data_dir] +
+                                             list(argv))
+        out = StringIO()
+        stdout, sys.stdout = sys.stdout, out
+        try:
+            _tag.run_args(self.targets(), args, _tag.NoConfirmSession())
+        finally:
+            sys.stdout = stdout
+        return out.getvalue().splitlines()
+
+    def test_untag_many_counts_removed_only(self):
+        out = self.run_cmd('repos', 'untag-many', 'general/web',
+                           'links:language/python')
+        self.assertEqual(out, ['Removed link web from a/b',
+                               'Skipped link web from c/d',
+                               '1 repos changed'])
+
+    def test_tag_many(self):
+        out = self.run_cmd('repos', 'tag-many', 'general/web',
+                           'links:language/python')
+        self.assertEqual(out[-1], '1 repos changed')
+
+
+class ReadSinceTest(DataDirTestCase):
+    def test_timestamps(self):
+        for i in ['2026-01-31', '2026-01-31 10:20', '2026-01-31T10:20:30',
+                  '2026-01-31T10:20:30.123456']:
+            self.assertEqual(_tag.read_since(i), i.replace(' ', 'T'))
+
+    def test_invalid_dates(self):
+        for i in ['2026-13-99', '2026-02-30', '2026-01-31T25:00', '2026-01',
+                  'yesterday']:
+            self.assertRaises(_tag.Error, _tag.read_since, i)
+
+    def test_checkpoint(self):
+        with self.in_data_dir():
+            with open('export.checkpoint', 'w') as f:
+                json.dump({'since': '2026-01-31T10:20:30'}, f)
+            self.assertEqual(_tag.read_since('export.checkpoint'),
+                             '2026-01-31T10:20:30')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,376 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+import BaseHTTPServer
+import SocketServer
+
+from tagg import Error
+from tagg import github
+from tagg.github import GithubHelper, RateLimiter
+
+from .support import DataDirTestCase
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Answers with server.respond(handler), which returns (status, headers,
+    # body), or None to drop the connection
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests.append(self.path)
+        r = self.server.respond(self)
+        if r is None:
+            self.close_connection = 1
+            return
+
+        status, headers, body = r
+        if not isinstance(body, str):
+            body = json.dumps(body)
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           StubHandler)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.respond = lambda handler: (404, {}, {'message': 'Not Found'})
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+
+def repo(full_name):
+    return {'full_name': full_name, 'fork': False, 'language': 'Python',
+            'description': full_name}
+
+
+class GithubTestCase(unittest.TestCase):
+    # A GithubHelper talking to a local stub of the Github API
+    def setUp(self):
+        self.stub = StubServer()
+        thread = threading.Thread(target=self.stub.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.stub.server_close)
+        self.addCleanup(self.stub.shutdown)
+
+        self.cache_dir = tempfile.mkdtemp(prefix='tagg-test-')
+        self.addCleanup(shutil.rmtree, self.cache_dir, True)
+        self.limiter = RateLimiter(backoff=0.01)
+        self.gh = GithubHelper('someone', api_root=self.stub.url, workers=4,
+                               rate_limiter=self.limiter)
+
+
+class ConcurrentFetchTest(GithubTestCase):
+    def test_get_repos_skips_failed(self):
+        def respond(handler):
+            if handler.path == '/repos/gone/repo':
+                return 404, {}, {'message': 'Not Found'}
+            if handler.path == '/repos/down/repo':
+                return None  # Connection dropped: a requests ConnectionError
+            return 200, {}, repo(handler.path[len('/repos/'):])
+        self.stub.respond = respond
+
+        keys = ['a/b', 'gone/repo', 'c/d', 'down/repo', 'e/f']
+        got = list(self.gh.get_repos(keys))
+        self.assertEqual([i and i['full_name'] for i in got],
+                         ['a/b', None, 'c/d', None, 'e/f'])
+
+    def test_pages_fetched_together_in_order(self):
+        url = self.stub.url + '/users/someone/repos?page=%d'
+        active = [0, 0]  # In flight, most in flight
+
+        def respond(handler):
+            page = int(handler.path.partition('page=')[2] or 1)
+            headers = {}
+            if page == 1:
+                headers['Link'] = '<%s>; rel="next", <%s>; rel="last"' % (
+                    url % 2, url % 5)
+            else:
+                with self.stub.lock:
+                    active[0] += 1
+                    active[1] = max(active)
+                # The first pages answer last
+                time.sleep(0.05 * (5 - page))
+                with self.stub.lock:
+                    active[0] -= 1
+            return 200, headers, [repo('p%d/r%d' % (page, i))
+                                  for i in xrange(2)]
+        self.stub.respond = respond
+
+        got = [i['full_name'] for i in self.gh.get_mine()]
+        self.assertEqual(got, ['p%d/r%d' % (page, i)
+                               for page in xrange(1, 6) for i in xrange(2)])
+        self.assertGreater(active[1], 1)
+
+
+class ResponseCacheTest(GithubTestCase):
+    def setUp(self):
+        super(ResponseCacheTest, self).setUp()
+        self.gh = GithubHelper(api_root=self.stub.url, workers=1,
+                               cache_dir=self.cache_dir,
+                               rate_limiter=self.limiter)
+        self.versions = {}  # full name -> version served
+
+        def respond(handler):
+            full_name = handler.path[len('/repos/'):]
+            version = self.versions.get(full_name, 0)
+            etag = '"%s-%d"' % (full_name, version)
+            if handler.headers.get('If-None-Match') == etag:
+                return 304, {'ETag': etag}, ''
+            data = repo(full_name)
+            data['description'] = 'version %d' % version
+            return 200, {'ETag': etag}, data
+        self.stub.respond = respond
+
+    def test_revalidated(self):
+        self.assertEqual(self.gh.get_repo('a/b')['description'], 'version 0')
+        # Sent with its ETag, answered 304, served from the cache
+        self.assertEqual(self.gh.get_repo('a/b')['description'], 'version 0')
+        self.assertEqual(len(self.stub.requests), 2)
+
+        self.versions['a/b'] = 1
+        self.assertEqual(self.gh.get_repo('a/b')['description'], 'version 1')
+        self.assertEqual(self.gh.get_repo('a/b')['description'], 'version 1')
+
+    def test_conditional_requests(self):
+        sent = []
+        respond = self.stub.respond
+
+        def record(handler):
+            r = respond(handler)
+            sent.append((handler.headers.get('If-None-Match'), r[0]))
+            return r
+        self.stub.respond = record
+
+        self.gh.get_repo('a/b')
+        self.gh.get_repo('a/b')
+        self.assertEqual(sent, [(None, 200), ('"a/b-0"', 304)])
+
+    def test_least_recently_used_evicted(self):
+        cache = self.gh.cache
+        self.gh.get_repo('a/a')
+        size = cache.size
+        # Room for three responses, the next one brings it down to two
+        cache.max_bytes = size * 3 + size / 2
+        for key in ['a/b', 'a/c']:
+            time.sleep(0.01)
+            self.gh.get_repo(key)
+        time.sleep(0.01)
+        self.gh.get_repo('a/a')  # Revalidated, so used again
+        time.sleep(0.01)
+        self.gh.get_repo('a/d')
+
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+        self.assertTrue(cache.get('%s %s/repos/a/a' % (self.gh.token,
+                                                       self.stub.url)))
+        self.assertTrue(cache.get('%s %s/repos/a/d' % (self.gh.token,
+                                                       self.stub.url)))
+        self.assertLessEqual(cache.size, cache.max_bytes)
+
+
+class RefreshTest(GithubTestCase, DataDirTestCase):
+    def setUp(self):
+        GithubTestCase.setUp(self)
+        DataDirTestCase.setUp(self)
+
+        def respond(handler):
+            full_name = handler.path[len('/repos/'):]
+            if full_name == 'e/f':
+                return 404, {}, {'message': 'Not Found'}
+            data = {'full_name': full_name, 'fork': None, 'language': None,
+                    'description': full_name}
+            if full_name == 'c/d':
+                data['description'] = 'changed'
+                data['language'] = 'Go'
+            return 200, {}, data
+        self.stub.respond = respond
+
+    def refresh(self, keys=None):
+        repostore = self.targets()['repos']
+        repostore._github = self.gh
+        return repostore.refresh(keys)
+
+    def test_changed_saved(self):
+        before = self.targets()['repos'].get('a/b').get('updated_at')
+        self.assertEqual(self.refresh(),
+                         [('c/d', ['language', 'description'])])
+        self.assertEqual(sorted(self.stub.requests),
+                         ['/repos/a/b', '/repos/c/d', '/repos/e/f'])
+
+        repostore = self.targets()['repos']
+        repo = repostore.get('c/d')
+        self.assertEqual(repo.get('description'), 'changed')
+        self.assertEqual(repo.get('language'), 'Go')
+        self.assertEqual([i.key for i in repo.links], ['language/python'])
+        self.assertEqual(repostore.find_keywords(['changed']), ['c/d'])
+        self.assertEqual(repostore.get('a/b').get('updated_at'), before)
+
+    def test_some_keys(self):
+        self.assertEqual(self.refresh(['A/B', 'a/b']), [])
+        self.assertEqual(self.stub.requests, ['/repos/a/b'])
+
+
+class FakeClock(object):
+    # Stands for the time module in tagg.github. Sleeping moves it forward
+    # at once. Whole seconds like the reset times sent by Github.
+    def __init__(self):
+        self.now = int(time.time())
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class RateLimiterTest(GithubTestCase):
+    def setUp(self):
+        super(RateLimiterTest, self).setUp()
+        self.clock = FakeClock()
+        github.time = self.clock
+        self.addCleanup(setattr, github, 'time', time)
+        self.gh.workers = 1
+
+    def rate_headers(self, limit, remaining, reset):
+        return {'X-RateLimit-Limit': str(limit),
+                'X-RateLimit-Remaining': str(remaining),
+                'X-RateLimit-Reset': str(int(reset))}
+
+    def test_waits_for_reset_when_spent(self):
+        window = {'remaining': 3, 'reset': self.clock.now + 100}
+
+        def respond(handler):
+            if self.clock.now >= window['reset']:
+                window.update(remaining=10, reset=self.clock.now + 3600)
+            window['remaining'] -= 1
+            return 200, self.rate_headers(10, window['remaining'],
+                                          window['reset']), repo('a/b')
+        self.stub.respond = respond
+
+        for i in xrange(3):
+            self.gh.get_repo('a/b')
+        self.assertEqual(self.clock.slept, [])
+        self.assertEqual(
+            self.limiter.metrics()['resources']['core']['remaining'], 0)
+
+        # Nothing left until the reset sent by Github
+        self.gh.get_repo('a/b')
+        self.assertEqual(self.clock.slept, [100])
+        self.assertEqual(len(self.stub.requests), 4)
+
+    def test_spreads_remaining_until_reset(self):
+        reset = self.clock.now + 1000
+
+        def respond(handler):
+            return 200, self.rate_headers(100, 10, reset), repo('a/b')
+        self.stub.respond = respond
+
+        # The first request tells how many are left, 10 of them go right away,
+        # then they come back at 10 per 1000s until the reset
+        for i in xrange(12):
+            self.gh.get_repo('a/b')
+        self.assertEqual(self.clock.slept, [100])
+
+    def test_bucket_per_resource(self):
+        reset = self.clock.now + 60
+
+        def respond(handler):
+            if handler.path.startswith('/search/'):
+                return 200, dict(self.rate_headers(2, 0, reset), **{
+                    'X-RateLimit-Resource': 'search'}), {'items': []}
+            return 200, dict(self.rate_headers(5000, 4999, reset + 3600), **{
+                'X-RateLimit-Resource': 'core'}), repo('a/b')
+        self.stub.respond = respond
+
+        list(self.gh.get_top1k())
+        # Search is spent, core isn't held back by it
+        for i in xrange(3):
+            self.gh.get_repo('a/b')
+        self.assertEqual(self.clock.slept, [])
+        resources = self.limiter.metrics()['resources']
+        self.assertEqual(resources['search']['remaining'], 0)
+        self.assertEqual(resources['core']['remaining'], 4999)
+
+        list(self.gh.get_top1k())
+        self.assertEqual(self.clock.slept, [60])
+
+    def test_not_modified_free(self):
+        self.gh = GithubHelper(api_root=self.stub.url, workers=1,
+                               cache_dir=self.cache_dir,
+                               rate_limiter=self.limiter)
+        reset = self.clock.now + 1000
+
+        def respond(handler):
+            headers = dict(self.rate_headers(100, 1, reset), ETag='"a/b"')
+            if handler.headers.get('If-None-Match') == '"a/b"':
+                return 304, headers, ''
+            return 200, headers, repo('a/b')
+        self.stub.respond = respond
+
+        # One left, taken by the first request, the revalidations that
+        # follow give theirs back
+        for i in xrange(5):
+            self.assertEqual(self.gh.get_repo('a/b')['full_name'], 'a/b')
+        self.assertEqual(self.clock.slept, [])
+        self.assertEqual(self.limiter.metrics()['not_modified'], 4)
+
+    def test_retries_after_reset(self):
+        reset = self.clock.now + 30
+
+        def respond(handler):
+            if self.clock.now < reset:
+                return 403, self.rate_headers(60, 0, reset), {
+                    'message': 'API rate limit exceeded'}
+            return 200, self.rate_headers(60, 59, reset + 3600), repo('a/b')
+        self.stub.respond = respond
+
+        self.assertEqual(self.gh.get_repo('a/b')['full_name'], 'a/b')
+        self.assertEqual(len(self.stub.requests), 2)
+        self.assertEqual(self.clock.slept, [30])
+        self.assertEqual(self.limiter.metrics()['retries'], 1)
+
+    def test_retry_after(self):
+        answers = [(403, {'Retry-After': '7'}, {'message': 'abuse'}),
+                   (200, {}, repo('a/b'))]
+        self.stub.respond = lambda handler: answers.pop(0)
+
+        self.assertEqual(self.gh.get_repo('a/b')['full_name'], 'a/b')
+        self.assertEqual(self.clock.slept, [7])
+
+    def test_backoff(self):
+        self.stub.respond = lambda handler: (429, {}, {'message': 'slow down'})
+
+        self.assertRaises(Error, self.gh.get_repo, 'a/b')
+        # Doubling each time, until it gives up
+        self.assertEqual(self.clock.slept, [0.01, 0.02, 0.04, 0.08, 0.16])
+        self.assertEqual(len(self.stub.requests), 6)
+
+    def test_forbidden_not_retried(self):
+        self.stub.respond = lambda handler: (403, {}, {'message': 'Nope'})
+
+        self.assertRaises(Error, self.gh.get_repo, 'a/b')
+        self.assertEqual(self.clock.slept, [])
+        self.assertEqual(len(self.stub.requests), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
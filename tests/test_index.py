@@ -0,0 +1,267 @@
+import os
+import json
+import shutil
+import unittest
+import os.path as path
+
+import tagg
+from tagg.index import KeyTrie
+
+from .support import DataDirTestCase
+
+
+class LinkIndexTest(DataDirTestCase):
+    def linked(self, targets, tag):
+        return targets['repos'].link_index.find(
+            [targets['tags'].get(tag)])
+
+    def test_save_keeps_journal_of_others(self):
+        # The index is saved by a process holding it loaded, a server say,
+        # after another one journaled changes
+        server = self.targets()
+        self.assertEqual(self.linked(server, 'general/web'), ['a/b'])
+        server['repos'].add_link('c/d', server['tags'].get('brand/x'))
+
+        local = self.targets()
+        local['repos'].add_link('e/f', local['tags'].get('general/web'))
+        server['repos'].flush()
+
+        self.assertEqual(self.linked(self.targets(), 'general/web'),
+                         ['a/b', 'e/f'])
+        self.assertEqual(self.linked(self.targets(), 'brand/x'), ['c/d'])
+
+    def test_save_after_another_save(self):
+        server = self.targets()
+        self.assertEqual(self.linked(server, 'general/web'), ['a/b'])
+        server['repos'].add_link('c/d', server['tags'].get('brand/x'))
+
+        local = self.targets()
+        self.assertEqual(self.linked(local, 'general/web'), ['a/b'])
+        local['repos'].add_link('e/f', local['tags'].get('general/web'))
+        local['repos'].flush()
+        server['repos'].flush()
+
+        self.assertEqual(self.linked(self.targets(), 'general/web'),
+                         ['a/b', 'e/f'])
+        self.assertEqual(self.linked(self.targets(), 'brand/x'), ['c/d'])
+
+
+class JournalTest(DataDirTestCase):
+    def index_dir(self, name):
+        return path.join(self.data_dir, '.tagg', 'repos.' + name)
+
+    def test_none_without_index(self):
+        # Nothing would replay it
+        targets = self.targets()
+        targets['repos'].add_link('e/f', targets['tags'].get('brand/x'))
+        targets['repos'].flush()
+        self.assertFalse(path.exists(self.index_dir('links')))
+
+    def test_folded_when_too_long(self):
+        targets = self.targets()
+        targets['repos'].find_keywords(['b'])
+        targets['repos'].flush()
+
+        log = path.join(self.index_dir('tokens'), 'log')
+        repostore = self.targets()['repos']
+        m = repostore.get('e/f')
+        m.meta['description'] = 'a gopher'
+        m.save()
+        repostore.flush()
+        self.assertTrue(path.isfile(log))
+
+        repostore.token_index.max_journal = 0
+        repostore.flush()
+        self.assertFalse(path.isfile(log))
+        self.assertEqual(self.targets()['repos'].find_keywords(['gopher']),
+                         ['e/f'])
+
+
+class ShardTest(DataDirTestCase):
+    # A lookup only reads the postings it needs
+    def setUp(self):
+        super(ShardTest, self).setUp()
+        targets = self.targets()
+        targets['repos'].link_index.find([])
+        targets['repos'].find_keywords(['b'])
+        targets['repos'].flush()
+
+        self.parsed = []
+        load_json = tagg.load_json
+
+        def counted(f):
+            self.parsed.append(path.basename(f.name))
+            return load_json(f)
+        tagg.load_json = counted
+        self.addCleanup(setattr, tagg, 'load_json', load_json)
+
+    def test_links(self):
+        targets = self.targets()
+        del self.parsed[:]
+        self.assertEqual(list(targets['repos'].find_links(
+            [targets['tags'].get('general/web')])), ['a/b'])
+        self.assertEqual(self.parsed, ['general%2Fweb.json'])
+
+    def test_tokens(self):
+        targets = self.targets()
+        del self.parsed[:]
+        self.assertEqual(targets['repos'].find_keywords(['d', 'b']),
+                         ['a/b', 'c/d'])
+        self.assertEqual(sorted(self.parsed), ['b.json', 'd.json'])
+
+    def test_journal_replayed(self):
+        targets = self.targets()
+        targets['repos'].add_link('e/f', targets['tags'].get('general/web'))
+        targets['repos'].remove_link('a/b', 'web')
+        targets['repos'].save_meta(targets['repos'].get('c/d'))
+
+        targets = self.targets()
+        del self.parsed[:]
+        self.assertEqual(list(targets['repos'].find_links(
+            [targets['tags'].get('general/web')])), ['e/f'])
+        self.assertEqual(self.parsed, ['general%2Fweb.json'])
+        # ! needs all the keys
+        self.assertEqual(targets['repos'].query('!general/web',
+                                                targets['tags']),
+                         ['a/b', 'c/d'])
+
+
+class OutsideChangesTest(DataDirTestCase):
+    # Changes made by other means than tagg, a git pull say, are found by
+    # rescan(), as run by the server and validate
+    def setUp(self):
+        super(OutsideChangesTest, self).setUp()
+        self.backdate()
+        targets = self.targets()
+        targets['repos'].find_keywords(['b'])
+        targets['repos'].link_index.find([])
+        targets['repos'].flush()
+
+    def repo_dir(self, key):
+        return path.join(self.data_dir, 'repos', key)
+
+    def rescanned(self):
+        targets = self.targets()
+        targets['repos'].rescan()
+        return targets
+
+    def find_links(self, tag):
+        targets = self.rescanned()
+        return list(targets['repos'].find_links([targets['tags'].get(tag)]))
+
+    def write_meta(self, key, meta):
+        if not path.isdir(self.repo_dir(key)):
+            os.makedirs(self.repo_dir(key))
+        with open(path.join(self.repo_dir(key), '__meta__.json'), 'w') as f:
+            json.dump(meta, f)
+
+    def test_unchanged(self):
+        targets = self.targets()
+        gets = []
+        get = targets['repos'].get
+        targets['repos'].get = lambda key, *args: gets.append(key) or get(
+            key, *args)
+        targets['repos'].rescan()
+        self.assertEqual(targets['repos'].find_keywords(['d']), ['c/d'])
+        self.assertEqual(targets['repos'].link_index.keys(),
+                         set(['a/b', 'c/d', 'e/f']))
+        self.assertEqual(gets, [])
+
+    def test_link_added(self):
+        os.symlink('../../../tags/general/web',
+                   path.join(self.repo_dir('e/f'), 'web'))
+        self.assertEqual(self.find_links('general/web'), ['a/b', 'e/f'])
+
+    def test_repo_added(self):
+        self.write_meta('g/h', {'description': 'pulled'})
+        os.symlink('../../../tags/brand/x', path.join(self.repo_dir('g/h'),
+                                                      'x'))
+        self.assertEqual(self.find_links('brand/x'), ['g/h'])
+        self.assertEqual(self.rescanned()['repos'].find_keywords(['pulled']),
+                         ['g/h'])
+
+    def test_repo_removed(self):
+        shutil.rmtree(self.repo_dir('a/b'))
+        self.assertEqual(self.find_links('language/python'), ['c/d'])
+        self.assertEqual(self.rescanned()['repos'].find_keywords(['b']), [])
+
+    def test_meta_edited(self):
+        self.write_meta('e/f', {'description': 'a gopher'})
+        self.assertEqual(self.rescanned()['repos'].find_keywords(['gopher']),
+                         ['e/f'])
+
+    def test_found_by_others(self):
+        # What a rescan finds is journaled for the lookups of the others
+        self.write_meta('e/f', {'description': 'a gopher'})
+        self.rescanned()
+        self.assertEqual(self.targets()['repos'].find_keywords(['gopher']),
+                         ['e/f'])
+
+
+class KeyTrieTest(DataDirTestCase):
+    def setUp(self):
+        super(KeyTrieTest, self).setUp()
+        self.targets_ = self.targets()
+        self.repos = KeyTrie(self.targets_['repos'])
+        self.tags = KeyTrie(self.targets_['tags'], unique=True)
+
+    def test_complete(self):
+        self.assertEqual(self.repos.complete('a'), ['a'])
+        self.assertEqual(self.repos.complete('A/'), ['a/b'])
+        self.assertEqual(self.repos.complete('c/d'), ['c/d'])
+        self.assertEqual(self.repos.complete(''), [])
+        self.assertEqual(self.repos.complete('zz'), [])
+        self.assertEqual(self.repos.complete('zz/'), [])
+
+    def test_unique(self):
+        # The last segments of the tags are completed at the top level
+        self.assertEqual(self.tags.complete('py'), ['python'])
+        self.assertEqual(self.tags.complete('general/'), ['general/web'])
+        self.assertEqual(self.repos.complete('py'), [])
+
+    def test_fuzzy(self):
+        # After the names starting with it, the ones with its letters in
+        # order
+        self.assertEqual(self.tags.complete('pn'), ['python'])
+        self.assertEqual(self.tags.complete('b'), ['brand', 'web'])
+        self.assertEqual(self.tags.complete('e', fuzzy_limit=2),
+                         ['general', 'language'])
+        self.assertEqual(self.tags.complete('e', fuzzy_limit=0), [])
+
+    def test_kept_up_to_date(self):
+        store = self.targets_['repos']
+        self.repos.load()
+        store.add_key('a/bc', {'description': 'bc'})
+        self.assertEqual(self.repos.complete('a/b'), ['a/b', 'a/bc'])
+        store.remove_key('a/b')
+        self.assertEqual(self.repos.complete('a/'), ['a/bc'])
+        store.rename_key('a/bc', 'g/h')
+        self.assertEqual(self.repos.complete('g/'), ['g/h'])
+        self.assertEqual(self.repos.complete('a/'), [])
+
+    def test_prune(self):
+        self.repos.load()
+        self.repos.add('x/y/z')
+        self.repos.add('x/y')
+        self.repos.remove('x/y/z')
+        self.assertEqual(self.repos.complete('x/'), ['x/y'])
+        self.assertEqual(self.repos.find('x/y').children, {})
+
+        # Nodes left with neither keys nor children go
+        self.repos.remove('x/y')
+        self.assertEqual(self.repos.find('x'), None)
+        self.repos.remove('a/b')
+        self.assertEqual(self.repos.find('a'), None)
+        self.assertEqual(self.repos.complete('x'), [])
+        self.assertNotEqual(self.repos.find('c'), None)
+
+    def test_remove_unknown(self):
+        self.repos.load()
+        self.repos.remove('a')
+        self.repos.remove('a/b/c')
+        self.repos.remove('q/r')
+        self.assertEqual(self.repos.complete('a/'), ['a/b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest
+
+from tagg import Error
+from tagg.query import parse_query, is_query
+
+from .support import DataDirTestCase
+
+
+def tag(name):
+    return ('tag', name)
+
+
+class ParseQueryTest(unittest.TestCase):
+    def test_tag(self):
+        self.assertEqual(parse_query('language/python'),
+                         tag('language/python'))
+        self.assertEqual(parse_query('  brand/*  '), tag('brand/*'))
+
+    def test_precedence(self):
+        # ! binds tighter than &, which binds tighter than |
+        self.assertEqual(parse_query('a | b & c'),
+                         ('or', [tag('a'), ('and', [tag('b'), tag('c')])]))
+        self.assertEqual(parse_query('a & b | c'),
+                         ('or', [('and', [tag('a'), tag('b')]), tag('c')]))
+        self.assertEqual(parse_query('!a & b'),
+                         ('and', [('not', tag('a')), tag('b')]))
+        self.assertEqual(parse_query('!!a'), ('not', ('not', tag('a'))))
+
+    def test_parens(self):
+        self.assertEqual(parse_query('(a | b) & c'),
+                         ('and', [('or', [tag('a'), tag('b')]), tag('c')]))
+        self.assertEqual(parse_query('!(a|b)'),
+                         ('not', ('or', [tag('a'), tag('b')])))
+
+    def test_comma_is_and(self):
+        self.assertEqual(parse_query('a,b & c'),
+                         ('and', [tag('a'), tag('b'), tag('c')]))
+
+    def test_errors(self):
+        for i in ['', 'a &', '& a', '(a', 'a)', '()', 'a b', '!', 'a | | b']:
+            self.assertRaises(Error, parse_query, i)
+
+    def test_is_query(self):
+        self.assertFalse(is_query('language/python,general/web'))
+        for i in ['a&b', 'a|b', '!a', '(a)', 'brand/*', 'general/?eb']:
+            self.assertTrue(is_query(i), i)
+
+
+class QueryTest(DataDirTestCase):
+    # a/b: language/python, general/web. c/d: language/python. e/f: none.
+    def query(self, expr):
+        targets = self.targets()
+        return targets['repos'].query(expr, targets['tags'])
+
+    def test_tags(self):
+        self.assertEqual(self.query('language/python'), ['a/b', 'c/d'])
+        self.assertEqual(self.query('language/python & general/web'),
+                         ['a/b'])
+        self.assertEqual(self.query('python, web'), ['a/b'])
+        self.assertEqual(self.query('general/web | brand/x'), ['a/b'])
+        self.assertEqual(self.query('brand/x'), [])
+
+    def test_not(self):
+        self.assertEqual(self.query('!language/python'), ['e/f'])
+        self.assertEqual(self.query('language/python & !general/web'),
+                         ['c/d'])
+        self.assertEqual(self.query('!general/web & !brand/x'),
+                         ['c/d', 'e/f'])
+        self.assertEqual(self.query('!(language/python | general/web)'),
+                         ['e/f'])
+
+    def test_precedence(self):
+        self.assertEqual(self.query('brand/x & general/web | python'),
+                         ['a/b', 'c/d'])
+        self.assertEqual(self.query('brand/x & (general/web | python)'), [])
+
+    def test_patterns(self):
+        self.assertEqual(self.query('general/*'), ['a/b'])
+        self.assertEqual(self.query('language/* & !general/*'), ['c/d'])
+        self.assertEqual(self.query('general/?eb'), ['a/b'])
+        self.assertEqual(self.query('none/*'), [])
+
+    def test_unknown_tag(self):
+        self.assertRaises(Error, self.query, 'language/python & nope/nope')
+
+
+if __name__ == '__main__':
+    unittest.main()
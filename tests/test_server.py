@@ -0,0 +1,110 @@
+import json
+import threading
+import unittest
+
+from tagg import cli as _tag
+from tagg.client import connect, request
+from tagg.server import TaggServer, StreamWriter
+
+from .support import DataDirTestCase
+
+
+class ServerTest(DataDirTestCase):
+    def setUp(self):
+        super(ServerTest, self).setUp()
+        self.server = TaggServer(self.data_dir, _tag.make_parser())
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(self.stop, thread)
+
+    def stop(self, thread):
+        self.server.shutdown()
+        thread.join()
+        self.server.close()
+
+    def run_cmd(self, *argv, **kwargs):
+        return request(connect(self.server.fn),
+                       ['-d', self.data_dir] + list(argv), **kwargs)
+
+    def test_show(self):
+        r = self.run_cmd('tags', 'show', 'general/web')
+        self.assertEqual(r['code'], 0, r['err'])
+        self.assertIn('general/web', r['out'])
+
+    def test_confirmations_answered_yes(self):
+        # Creating the missing tag asks for a confirmation, which can't be
+        # read from the terminal of the server
+        r = self.run_cmd('repos', 'tag', 'e/f', 'new/tag')
+        self.assertEqual(r['code'], 0, r['err'])
+        self.assertTrue(self.exists('tags', 'new/tag'))
+        repo = self.targets()['repos'].get('e/f')
+        self.assertEqual([i.key for i in repo.links], ['new/tag'])
+
+    def test_renamed_tag(self):
+        r = self.run_cmd('tags', 'rename', 'brand/x', 'brand/y')
+        self.assertEqual(r['code'], 0, r['err'])
+        r = self.run_cmd('tags', 'list')
+        self.assertIn('brand/y', r['out'].splitlines())
+        self.assertNotIn('brand/x', r['out'].splitlines())
+        r = self.run_cmd('export')
+        self.assertEqual(sorted(json.loads(r['out'])['tags']),
+                         ['brand/y', 'general/web', 'language/python'])
+
+    def test_export_streamed(self):
+        # In chunks written by the client as they come, not all at the end
+        self.addCleanup(setattr, StreamWriter, 'chunk_size',
+                        StreamWriter.chunk_size)
+        StreamWriter.chunk_size = 100
+        chunks = []
+
+        class Out(object):
+            write = chunks.append
+
+            def flush(self):
+                pass
+        r = self.run_cmd('export', out=Out())
+        self.assertEqual(r, {'code': 0, 'err': ''})
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(sorted(json.loads(''.join(chunks))['tags']),
+                         ['brand/x', 'general/web', 'language/python'])
+
+    def test_tag_removed_by_another(self):
+        local = self.targets()
+        local['tags'].remove_key('brand/x')
+        local['repos'].flush()
+        r = self.run_cmd('tags', 'show', 'brand/x')
+        self.assertIn("doesn't exist", r['out'])
+
+        # Created again, not linked dangling
+        r = self.run_cmd('repos', 'tag', 'e/f', 'brand/x')
+        self.assertEqual(r['code'], 0, r['err'])
+        self.assertTrue(self.exists('tags', 'brand/x'))
+        repo = self.targets()['repos'].get('e/f')
+        self.assertEqual([i.key for i in repo.links], ['brand/x'])
+
+    def test_piped_tag_seen(self):
+        self.run_cmd('repos', 'links', 'general/web')
+        self.pipe(['repos tag e/f general/web'])
+        r = self.run_cmd('repos', 'links', 'general/web')
+        self.assertEqual(r['out'].splitlines(), ['a/b', 'e/f'])
+
+    def test_piped_run_locally(self):
+        # The client runs them, streaming its stdin
+        self.assertEqual(self.run_cmd(tty=False), {'local': True})
+        self.assertEqual(self.run_cmd('tags', 'show', 'general/web',
+                                      tty=False), {'local': True})
+        self.assertEqual(self.run_cmd('repos', 'tag', '%', 'general/web',
+                                      tty=False), {'local': True})
+        self.assertEqual(self.run_cmd('repos', 'tag-many', 'general/web',
+                                      tty=False), {'local': True})
+
+    def test_tag_many(self):
+        r = self.run_cmd('repos', 'tag-many', 'brand/x',
+                         'links:language/python')
+        self.assertEqual(r['code'], 0, r['err'])
+        self.assertIn('2 repos changed', r['out'])
+
+
+if __name__ == '__main__':
+    unittest.main()
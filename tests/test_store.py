@@ -0,0 +1,121 @@
+import os
+import json
+import shutil
+import unittest
+import os.path as path
+
+import tagg
+
+from .support import DataDirTestCase
+
+
+class CachedMetaTest(DataDirTestCase):
+    def setUp(self):
+        super(CachedMetaTest, self).setUp()
+        self.tagstore = tagg.UniqueCachedMetaStore(
+            'Tags', path.join(self.data_dir, 'tags'))
+        self.parsed = []
+        load_json = tagg.load_json
+
+        def counted(f):
+            self.parsed.append(f.name)
+            return load_json(f)
+        tagg.load_json = counted
+        self.addCleanup(setattr, tagg, 'load_json', load_json)
+
+    def test_parsed_once(self):
+        # By the first copy to read it, into the cached Meta shared by all
+        self.assertEqual(self.tagstore.get('general/web').get('updated_at'),
+                         self.tagstore.get('web').meta['updated_at'])
+        self.tagstore.get('general/web').get('created_at')
+        self.assertEqual(len(self.parsed), 1)
+
+    def test_copies_changed_apart(self):
+        m = self.tagstore.get('general/web')
+        m.meta['color'] = 'red'
+        self.assertEqual(self.tagstore.get('general/web').get('color'), None)
+        m.save()
+        self.assertEqual(self.tagstore.get('general/web').get('color'), 'red')
+
+
+class SaveTest(DataDirTestCase):
+    def test_saved_unparsed(self):
+        # Its json is read before it's written over
+        repostore = self.targets()['repos']
+        repostore.save_meta(repostore.get('c/d'))
+        self.assertEqual(self.targets()['repos'].get('c/d').get(
+            'description'), 'c/d')
+
+
+class SnapshotTest(DataDirTestCase):
+    # The tag store starts from the snapshot of the last run, which changes
+    # made by other means than tagg must not go past
+    def setUp(self):
+        super(SnapshotTest, self).setUp()
+        self.backdate()
+        self.tagstore()  # Writes the snapshot
+
+    def tagstore(self):
+        return self.targets()['tags']
+
+    def tag_dir(self, key):
+        return path.join(self.data_dir, 'tags', key)
+
+    def write_meta(self, key, meta):
+        if not path.isdir(self.tag_dir(key)):
+            os.makedirs(self.tag_dir(key))
+        with open(path.join(self.tag_dir(key), '__meta__.json'), 'w') as f:
+            json.dump(meta, f)
+
+    def test_unchanged(self):
+        loaded = []
+        load_meta = tagg.MetaStore.load_meta
+        tagg.MetaStore.load_meta = lambda self, meta, *args: loaded.append(
+            meta.key) or load_meta(self, meta, *args)
+        self.addCleanup(setattr, tagg.MetaStore, 'load_meta', load_meta)
+
+        tagstore = self.tagstore()
+        self.assertEqual(loaded, [])
+        self.assertEqual(sorted(tagstore.keys()),
+                         ['brand/x', 'general/web', 'language/python'])
+        self.assertTrue(tagstore.get('web').exists)
+
+    def test_tag_added(self):
+        self.write_meta('general/cli', {'color': 'red'})
+        tagstore = self.tagstore()
+        self.assertIn('general/cli', tagstore.keys())
+        self.assertEqual(tagstore.get('cli').get('color'), 'red')
+
+    def test_domain_added(self):
+        self.write_meta('framework/django', {})
+        self.assertTrue(self.tagstore().get('django').exists)
+
+    def test_tag_removed(self):
+        shutil.rmtree(self.tag_dir('brand/x'))
+        tagstore = self.tagstore()
+        self.assertNotIn('brand/x', tagstore.keys())
+        self.assertFalse(tagstore.get('x').exists)
+
+    def test_domain_removed(self):
+        shutil.rmtree(self.tag_dir('general'))
+        self.assertEqual(sorted(self.tagstore().keys()),
+                         ['brand/x', 'language/python'])
+
+    def test_rescanned(self):
+        tagstore = self.tagstore()
+        shutil.rmtree(self.tag_dir('brand/x'))
+        self.write_meta('general/cli', {})
+        tagstore.rescan()
+        self.assertEqual(sorted(tagstore.keys()),
+                         ['general/cli', 'general/web', 'language/python'])
+        self.assertFalse(tagstore.get('x').exists)
+        self.assertTrue(tagstore.get('cli').exists)
+
+    def test_tag_changed(self):
+        self.write_meta('general/web', {'color': 'blue'})
+        self.assertEqual(self.tagstore().get('general/web').get('color'),
+                         'blue')
+
+
+if __name__ == '__main__':
+    unittest.main()